@@ -1,8 +1,15 @@
 from disc2radmc.constants import *
 from disc2radmc.functions_misc import *
+from disc2radmc.mie import *
+from disc2radmc.model import workspace
+from disc2radmc.model import radmc3d_job
+from disc2radmc.model import radmc3d_session
 from disc2radmc.model import simulation
 from disc2radmc.model import gas
 from disc2radmc.model import dust
+from disc2radmc.model import opacity_cache
+from disc2radmc.model import opacity_table
 from disc2radmc.model import star
+from disc2radmc.model import stellar_library
 from disc2radmc.model import wavelength_grid
 from disc2radmc.model import physical_grid
@@ -4,14 +4,17 @@
 
 
 import numpy as np
-import cmath as cma
 from disc2radmc.constants import *
 from astropy.io import fits
 from astropy.convolution import convolve_fft
 from scipy.ndimage.interpolation import shift
 from scipy import interpolate
+from scipy.spatial import cKDTree
 
 import os
+import hashlib
+import shutil, tempfile, subprocess
+from concurrent.futures import ProcessPoolExecutor
 
 # function to define vertical distribution
 def rhoz_Gaussian(z, H):
@@ -23,62 +26,524 @@ def effnk_bruggeman(n1,k1,n2,k2,n3,k3,f2,f3):
     # mixing rule Bruggeman http://en.wikipedia.org/wiki/Effective_medium_approximations
     # Sum fi* (epi-ep)/(epi+2ep) = 0, but normilizing by f1
     # fi are the volume fractions normalized by f1
+    # all arguments can be arrays (broadcast against each other), e.g. optical constants at many wavelengths
  
-    np1=n1+k1*1j # matrix
-    np2=n2+k2*1j # inclusion 1
-    np3=n3+k3*1j # inclusion 2
+    np1=np.asarray(n1+k1*1j, dtype=complex) # matrix
+    np2=np.asarray(n2+k2*1j, dtype=complex) # inclusion 1
+    np3=np.asarray(n3+k3*1j, dtype=complex) # inclusion 2
+    f2=np.asarray(f2, dtype=float)
+    f3=np.asarray(f3, dtype=float)
 
     e1=np1**2.0  # n = sqrt(epsilon_r x mu_r) and mu_r is aprox 1
     e2=np2**2.0
     e3=np3**2.0
 
     # polynomial of third order
-    p=np.zeros(4, dtype=complex)
-
-    p[3]=e1*e2*e3*(1.0+f2+f3) # 0 order
-    p[2]=-e1*e3*f2 -e1*e2*f3 - e2*e3 + 2*(e1*e2*f2 + e1*e2 +e1*e3*f3+e1*e3+e2*e3*f2+e2*e3*f3) # 1st order
-    p[1]= -2.0*(e1*f2+e1*f3+e3*f2+e2*f3+e2+e3)+4.0*(e1+e2*f2+e3*f3)# 2nd order
-    p[0]= -4.0*(1.0+f2+f3)
-
-    roots=np.roots(p) 
-
-    # check roots
-    for i in range(len(roots)):
-        effi=roots[i]
-        if effi.real>0.0 and effi.imag>0.0:
-            return cma.sqrt(effi)
-    ### if nothing satisfies the above condition
-        
-    return -1.0
+    p3=e1*e2*e3*(1.0+f2+f3) # 0 order
+    p2=-e1*e3*f2 -e1*e2*f3 - e2*e3 + 2*(e1*e2*f2 + e1*e2 +e1*e3*f3+e1*e3+e2*e3*f2+e2*e3*f3) # 1st order
+    p1= -2.0*(e1*f2+e1*f3+e3*f2+e2*f3+e2+e3)+4.0*(e1+e2*f2+e3*f3)# 2nd order
+    p0= -4.0*(1.0+f2+f3)
+    p0, p1, p2, p3 = np.broadcast_arrays(p0, p1, p2, p3)
+    shape=p0.shape
+
+    # roots as eigenvalues of the companion matrices (as np.roots)
+    A=np.zeros(shape+(3,3), dtype=complex)
+    A[...,0,0]=-p1/p0
+    A[...,0,1]=-p2/p0
+    A[...,0,2]=-p3/p0
+    A[...,1,0]=1.
+    A[...,2,1]=1.
+    roots=np.linalg.eigvals(A)
+    # a vanishing 0 order term (e.g. only two components) gives an exact root at 0 that np.roots removes
+    imin=np.argmin(np.abs(roots), axis=-1)
+    np.put_along_axis(roots, imin[...,None], np.where(p3[...,None]==0., 0., np.take_along_axis(roots, imin[...,None], axis=-1)), axis=-1)
+
+    # check roots: the first one with positive real and imaginary parts
+    valid=(roots.real>0.0) & (roots.imag>0.0)
+    effi=np.take_along_axis(roots, np.argmax(valid, axis=-1)[...,None], axis=-1)[...,0]
+    ### if nothing satisfies the above condition returns -1
+    eff=np.where(np.any(valid, axis=-1), np.sqrt(effi), -1.0)
+    return eff if eff.ndim else eff[()]
 
 def effnk_mg(n1,k1,n2,k2,f2): 
 
     # mixing rule Maxwell-Garnett http://en.wikipedia.org/wiki/Effective_medium_approximations
     # fi are the volume fractions
+    # all arguments can be arrays (broadcast against each other)
  
-    np1=n1+k1*1j # matrix
-    np2=n2+k2*1j # inclusion 1
+    np1=np.asarray(n1+k1*1j, dtype=complex) # matrix
+    np2=np.asarray(n2+k2*1j, dtype=complex) # inclusion 1
 
     e1=np1**2.0  # n = sqrt(epsilon_r x mu_r) and mu_r is aprox 1
     e2=np2**2.0
     
-    return cma.sqrt(  e1*(2*f2*(e2-e1)+e2+2*e1)/(2*e1+e2-f2*(e2-e1)))
-        
+    return np.sqrt(  e1*(2*f2*(e2-e1)+e2+2*e1)/(2*e1+e2-f2*(e2-e1)))
+
+def effnk_mix(n, k, volume_weights, mixing_method='Bruggeman', porosity=0.):
+
+    # effective refractive index of a mixture of materials with optical constants n[i] and k[i] (arrays over wavelength) and volume 
+    # fractions volume_weights (that sum 1), using Bruggeman rule for max 3 species or Maxwell-Garnett for 2 species.
+    # A fraction porosity of the final volume is then filled with vacuum.
+
+    # materials with no volume are removed, as they do not change the effective index (and the Bruggeman rule below is
+    # normalized by the volume of the first material, so it cannot be zero)
+    volume_weights=np.asarray(volume_weights, dtype=float)
+    n=[n[i] for i in range(len(n)) if volume_weights[i]>0.]
+    k=[k[i] for i in range(len(k)) if volume_weights[i]>0.]
+    volume_weights=volume_weights[volume_weights>0.]
+
+    voli=volume_weights/volume_weights[0] # normalized to the volume weight of the first species as required in Bruggeman rule's implementation
+    N_opct=len(n)
+    if N_opct==3:
+        eff=effnk_bruggeman(n[0],k[0],n[1],k[1],n[2],k[2],voli[1],voli[2])
+    elif N_opct==2 and mixing_method=='Bruggeman':
+        eff=effnk_bruggeman(n[0],k[0],n[1],k[1],0.,0.,voli[1],0.)
+    elif N_opct==2 and mixing_method=='MG':
+        eff=effnk_mg(n[0],k[0],n[1],k[1],volume_weights[1])
+    else: # one species
+        eff=n[0]+k[0]*1j
+
+    # now we add porosity using Maxwell Garnet Equation
+    if porosity>0: 
+        # refractive index of vacuum
+        nv=1.000001 # Vosgchinnikov+2005 https://www.aanda.org/articles/aa/abs/2005/02/aa3679/aa3679.html
+        kv=0.       # Vosgchinnikov+2005 https://www.aanda.org/articles/aa/abs/2005/02/aa3679/aa3679.html
+
+        if mixing_method=='MG':
+            eff=effnk_mg(eff.real,eff.imag,nv,kv,porosity)
+        else:
+            eff=effnk_bruggeman(eff.real,eff.imag,nv,kv,0.,0.,porosity/(1-porosity),0.)
+    return eff
+
+### functions to write radmc3d input files
+
+def radmc3d_order(field, mirror=True):
+    # reorder a field with shape (..., Nth, Nphi, Nr), where theta goes from the midplane to the N pole,
+    # into the (..., Nphi, Ntheta, Nr) order used by radmc3d, where theta goes from the N pole to the midplane.
+    # If mirror=False, the southern emisphere is added by mirroring the northern one.
+    # Axisymmetric fields broadcast along phi (zero stride) are reordered on a single phi slice and broadcast again.
+    if field.shape[-2]>1 and field.strides[-2]==0:
+        field_radmc=radmc3d_order(field[..., :1, :], mirror)
+        return np.broadcast_to(field_radmc, field_radmc.shape[:-3]+(field.shape[-2],)+field_radmc.shape[-2:])
+    field_radmc=field[..., ::-1, :, :] # northern emisphere
+    if not mirror:
+        field_radmc=np.concatenate((field_radmc, field), axis=-3) # southern emisphere
+    return np.swapaxes(field_radmc, -3, -2)
+
+def from_radmc3d_order(field, Nphi, Nr):
+    # view of a field read from radmc3d, with shape (..., Ncells), as (..., Ntheta, Nphi, Nr) with theta going from the
+    # midplane to the N pole as in the rest of the package (radmc3d_order inverted). For grids without mirror symmetry,
+    # the 2*Nth theta cells go from the S pole to the N pole, so [..., Nth:, :, :] is the northern emisphere.
+    field_radmc=field.reshape(field.shape[:-1]+(Nphi, -1, Nr))
+    return np.swapaxes(field_radmc, -3, -2)[..., ::-1, :, :]
+
+def broadcast_phi(field, Nphi):
+    # broadcast a field computed on a single phi slice, with shape (..., Nth, 1, Nr), to Nphi cells without copying it.
+    # The result is a read-only view that the writers stream one block at a time.
+    return np.broadcast_to(field, field.shape[:-2]+(Nphi,)+field.shape[-1:])
+
+def field_blocks(data, max_size=1000000):
+    # iterate over C-ordered contiguous blocks of an array, splitting its leading axes so that each block has at most
+    # max_size elements (or one element of the last axis if that is larger). Lazy (broadcast) arrays are only
+    # materialised block by block.
+    k=0
+    while k<data.ndim-1 and data[(0,)*k].size>max_size:
+        k+=1
+    for index in np.ndindex(*data.shape[:k]):
+        yield data[index]
+
+def radmc3d_blocks(field, mirror=True, max_size=1000000):
+    # iterate over a field with shape (..., Nth, Nphi, Nr) in radmc3d order (see radmc3d_order), reordering groups of
+    # phi slices of at most max_size elements at a time, so large (e.g. memory-mapped) fields are never copied in full.
+    Nphi_block=max(1, max_size//(field.shape[-3]*field.shape[-1]*(1 if mirror else 2)))
+    for index in np.ndindex(*field.shape[:-3]):
+        for i in range(0, field.shape[-2], Nphi_block):
+            yield radmc3d_order(field[index+(slice(None), slice(i, i+Nphi_block))], mirror)
+
+def write_binary_field(path, data, Ncells, Nspecies=None, mirror=None):
+    # write a field in radmc3d's unformatted layout: int64 header with iformat, precision (8 bytes), number of cells
+    # and number of species if needed, followed by the data in double precision. Data must already be in radmc3d order,
+    # unless mirror is given, in which case data has shape (..., Nth, Nphi, Nr) and is reordered block by block.
+    header=[1, 8, Ncells]
+    if Nspecies is not None:
+        header.append(Nspecies)
+    data=np.asarray(data)
+    with open(path, 'wb') as file_binary:
+        np.array(header, dtype=np.int64).tofile(file_binary)
+        for block in (field_blocks(data) if mirror is None else radmc3d_blocks(data, mirror)):
+            np.ascontiguousarray(block, dtype=np.float64).tofile(file_binary)
+
+def write_ascii_array(file, data, fmt='%r', delimiter='\t ', newline=' \n', chunk_size=100000):
+    # write the rows of a 1D (one value per line) or 2D array to an open file. Lines are formatted
+    # in large chunks instead of one write per value. fmt='%r' reproduces str() of each value.
+    data=np.asarray(data)
+    if data.ndim==1:
+        data=data[:,None]
+    line=delimiter.join([fmt]*data.shape[1])+newline
+    for i in range(0, data.shape[0], chunk_size):
+        chunk=data[i:i+chunk_size]
+        file.write((line*chunk.shape[0])%tuple(chunk.ravel().tolist()))
+
+def read_ascii_numbers(f, block_size=2**22):
+    # generator of arrays with the numbers in a text file opened in binary mode, parsed with numpy's tokenizer in blocks of
+    # about block_size bytes (cut at the end of a line) to avoid having the whole text in memory
+    rest=b''
+    while True:
+        block=f.read(block_size)
+        if not block:
+            break
+        block=rest+block
+        cut=block.rfind(b'\n')+1
+        rest=block[cut:]
+        if cut:
+            yield np.fromstring(block[:cut], sep=' ')
+    if rest.strip():
+        yield np.fromstring(rest, sep=' ')
+
+def write_radmc3d_field(path, data, Ncells, Nspecies=None, binary=False, fmt='%r', mirror=None, extensions=('.inp', '.binp')):
+    # write a field (already in radmc3d order) to path+'.inp' or path+'.binp', removing the other one so radmc3d reads the right file.
+    # extensions: ASCII and binary extensions (e.g. ('.dat', '.bdat') for dust_temperature)
+    # If data has one value per cell (and species) all values are written in one column, otherwise the last axis is
+    # written as columns (e.g. the 3 velocity components). The field is written in blocks, so broadcast views are never fully expanded.
+    # If mirror is given, data has one value per cell with shape (..., Nth, Nphi, Nr) and it is put in radmc3d order block by block.
+    if binary:
+        write_binary_field(path+extensions[1], data, Ncells, Nspecies=Nspecies, mirror=mirror)
+        remove_file(path+extensions[0])
+    else:
+        data=np.asarray(data)
+        Nvalues=Ncells*(Nspecies if Nspecies is not None else 1)
+        Ncolumns=data.size//Nvalues if mirror is None else 1
+        with open(path+extensions[0], 'w') as file_field:
+            file_field.write('1 \n') # iformat
+            file_field.write(str(Ncells)+' \n') # n cells
+            if Nspecies is not None:
+                file_field.write(str(Nspecies)+' \n') # n species
+            for block in (field_blocks(data) if mirror is None else radmc3d_blocks(data, mirror)):
+                write_ascii_array(file_field, block.reshape(-1, Ncolumns), fmt=fmt)
+        remove_file(path+extensions[1])
+
+def read_radmc3d_field(path):
+    # read a field written by radmc3d or write_radmc3d_field (e.g. dust_temperature.dat or .bdat, gas_temperature.inp or .binp)
+    # and return it with shape (Nspecies, Ncells) in radmc3d order (Nspecies=1 for fields without species).
+    # Binary files (.binp, .bdat) are memory-mapped and ASCII files are parsed in blocks.
+    if path.endswith(('.binp', '.bdat')):
+        iformat, precision, Ncells, Nspecies = np.fromfile(path, dtype=np.int64, count=4)
+        Nheader=4
+        if 3*8+Ncells*precision==os.path.getsize(path): # no number of species in the header
+            Nspecies, Nheader = 1, 3
+        dtype=np.float64 if precision==8 else np.float32
+        return np.memmap(path, dtype=dtype, mode='r', offset=Nheader*8, shape=(int(Nspecies), int(Ncells)))
+    with open(path, 'rb') as file_field:
+        numbers=np.concatenate(list(read_ascii_numbers(file_field)))
+    Ncells=int(numbers[1])
+    if len(numbers)==2+Ncells: # no number of species
+        return numbers[2:].reshape(1, Ncells)
+    return numbers[3:].reshape(int(numbers[2]), Ncells)
+
+def read_opacity(path):
+    # read the wavelengths (um) and absorption opacities (cm2/g) of a dustkappa_*.inp or dustkapscatmat_*.inp file (comment lines start with #)
+    with open(path, 'rb') as file_opacity:
+        numbers=np.fromstring(b''.join(line for line in file_opacity if not line.lstrip().startswith(b'#')), sep=' ')
+    if os.path.basename(path).startswith('dustkapscatmat_'): # iformat, Nlam, Nangles and 4 columns
+        Nlam, Ncolumns, start = int(numbers[1]), 4, 3
+    else: # iformat is the number of opacity columns
+        Nlam, Ncolumns, start = int(numbers[1]), int(numbers[0])+1, 2
+    table=numbers[start:start+Nlam*Ncolumns].reshape(Nlam, Ncolumns)
+    return table[:,0], table[:,1]
+
+def edge_index(x, edges, spacing=None):
+    # index of the bin containing each x given increasing bin edges, or -1 outside [edges[0], edges[-1]] (the last bin
+    # includes its right edge, as in np.histogramdd). For spacing='linear' or 'log' the index is computed directly from the
+    # first bin instead of searching the edges, and then corrected by one bin if needed for rounding errors.
+    x=np.asarray(x, dtype=float)
+    Nbins=len(edges)-1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if spacing=='linear':
+            i=np.floor((x-edges[0])/(edges[1]-edges[0]))
+        elif spacing=='log':
+            i=np.floor(np.log(x/edges[0])/np.log(edges[1]/edges[0]))
+        else:
+            i=np.searchsorted(edges, x, side='right')-1.
+    i=np.clip(np.nan_to_num(i), 0, Nbins-1).astype(np.int64)
+    i=np.where(x<edges[i], i-1, np.where(x>=edges[i+1], i+1, i))
+    i=np.minimum(i, Nbins-1)
+    i[~((x>=edges[0]) & (x<=edges[-1]))]=-1
+    return i
+
+def cubic_spline_kernel(q, h):
+    # 3D cubic spline (M4) smoothing kernel with compact support q=d/h<2
+    return np.where(q<1., 1.-1.5*q**2+0.75*q**3, np.where(q<2., 0.25*(2.-q)**3, 0.))/(np.pi*h**3)
+
+def kernel_deposit(xyz, h, weights, species, cell, tree, dV, minlength, max_pairs=10000000):
+    # mass deposited in each cell by particles at cartesian positions xyz with smoothing lengths h and masses weights, spread
+    # with a cubic spline kernel over the cell centres stored in a cKDTree (with volumes dV). The tree can hold each centre more than
+    # once (e.g. mirrored to the southern emisphere), its point j being cell j%len(dV). species is the species (size bin) of
+    # each particle, or -1 to ignore it, and cell the flat index of the cell that contains it, or -1 if it is outside the grid.
+    # Kernel weights are normalized over the cells of each particle to conserve its mass, and particles that do not reach any cell
+    # centre are deposited in their own cell. Particles outside the grid (e.g. just inside rmin or beyond rmax) deposit the part of
+    # their kernel that overlaps with the grid (kernel times cell volume summed over the cells they reach, at most their mass).
+    # The particle-cell pairs within reach are computed in batches of at most max_pairs pairs (~24 bytes each), so memory does
+    # not grow with the number of particles or their smoothing lengths.
+    Ncells=len(dV)
+    mass=np.zeros(minlength)
+    used=species>=0
+    xyz, h, weights, species, cell = xyz[used], h[used], weights[used], species[used], cell[used]
+    unresolved=np.flatnonzero(~(h>0.) & (cell>=0))
+    # particles are grouped by smoothing length (within factors of 2), so all cells within 2h of a group are found with a single tree query
+    groups=np.floor(np.log2(np.where(h>0., h, 1.)))
+    for group in np.unique(groups[h>0.]):
+        p=np.flatnonzero((groups==group) & (h>0.))
+        radius=2.*h[p].max()
+        counts=np.cumsum(tree.query_ball_point(xyz[p], radius, return_length=True))
+        i0=0
+        while i0<len(p):
+            i1=max(i0+1, np.searchsorted(counts, (counts[i0-1] if i0>0 else 0)+max_pairs, side='right'))
+            pb=p[i0:i1]
+            i0=i1
+            pairs=cKDTree(xyz[pb]).sparse_distance_matrix(tree, radius, output_type='ndarray')
+            ip, jc = pairs['i'], pairs['j']%Ncells
+            q=pairs['v']/h[pb][ip]
+            ip, jc, q = ip[q<2.], jc[q<2.], q[q<2.]
+            w=cubic_spline_kernel(q, h[pb][ip])*dV[jc]
+            norm=np.bincount(ip, weights=w, minlength=len(pb))
+            inside=cell[pb]>=0
+            unresolved=np.concatenate((unresolved, pb[(norm==0.) & inside]))
+            scale=np.where(inside, 1./np.where(norm>0., norm, 1.), 1./np.maximum(norm, 1.))
+            mass+=np.bincount(species[pb][ip]*Ncells+jc, weights=w*(weights[pb]*scale)[ip], minlength=minlength)
+    mass+=np.bincount(species[unresolved]*Ncells+cell[unresolved], weights=weights[unresolved], minlength=minlength)
+    return mass
+
+# cell-centre tree, cell volumes and output length of a kernel deposition, set once in each process of its pool
+kernel_cells={}
+
+def init_kernel_deposit(tree, dV, minlength):
+    # initializer of the processes of a kernel deposition pool, so the tree is sent to each process only once
+    kernel_cells.update(tree=tree, dV=dV, minlength=minlength)
+
+def kernel_deposit_chunk(xyz, h, weights, species, cell):
+    # kernel_deposit of a chunk of particles in a process started with init_kernel_deposit
+    return kernel_deposit(xyz, h, weights, species, cell, kernel_cells['tree'], kernel_cells['dV'], kernel_cells['minlength'])
+
+def hash_inputs(*inputs):
+    # sha256 hash of a sequence of inputs (bytes, strings, numbers, arrays or lists of them), e.g. to identify files computed from them
+    sha=hashlib.sha256()
+    for item in inputs:
+        if isinstance(item, bytes):
+            sha.update(b'b'+item)
+        elif isinstance(item, str):
+            sha.update(b's'+item.encode())
+        elif isinstance(item, (list, tuple)):
+            sha.update(b'l'+hash_inputs(*item).encode())
+        elif item is None:
+            sha.update(b'n')
+        else:
+            item=np.asarray(item)
+            sha.update(('a'+item.dtype.str+str(item.shape)).encode())
+            for block in field_blocks(item): # large (e.g. broadcasted or memory-mapped) arrays are hashed in blocks
+                sha.update(np.ascontiguousarray(block).tobytes())
+    return sha.hexdigest()
+
+class file_lock:
+    # exclusive lock on a file (flock) held within a with block, so that only one process at a time modifies shared files.
+    # Without fcntl (e.g. on Windows) no lock is taken
+    def __init__(self, path):
+        self.path=path
+
+    def __enter__(self):
+        self.lock=open(self.path, 'w')
+        try:
+            import fcntl
+            fcntl.flock(self.lock, fcntl.LOCK_EX)
+        except ImportError:
+            pass
+        return self
+
+    def __exit__(self, *exc):
+        self.lock.close() # closing the file releases the lock
+
+def remove_file(path):
+    # remove file if it exists (e.g. to avoid radmc3d reading an old .inp twin of a .binp file)
+    if os.path.exists(path):
+        os.remove(path)
+
+def integrate_size_distribution(function, edges, slope, order=4, rtol=1.0e-3, max_iter=12):
+    """
+    Mass-weighted averages of a function of grain size over size bins, computed with adaptive Newton-Cotes quadrature in log(a).
+    Each interval is integrated with order+1 equispaced nodes and with the same rule on its two halves (2*order+1 nodes), and the
+    difference is taken as its error. Intervals whose error is above their share of rtol are halved, reusing the nodes they already
+    have, so each refinement only evaluates order new sizes per half. Intervals that are resolved are not refined any further.
+    All the sizes needed at each iteration are evaluated with a single call of function.
+
+    function: function of an array of sizes that returns an array with shape (Na, ...), e.g. opacities at many wavelengths
+    edges: edges of the size bins (Nbins+1)
+    slope: slope of the size distribution (dn/da propto a^slope), so that the mass per log(a) is propto a^(slope+4)
+    order: degree of the Newton-Cotes rule (even, e.g. 2 for Simpson's rule and 4 for Boole's rule)
+    rtol: relative tolerance of the averages (maximum over all elements)
+    max_iter: maximum number of refinements
+
+    returns the averages with shape (Nbins, ...), the estimated relative error of each bin and the number of sizes evaluated
+    """
+    assert order>=2 and order%2==0, 'order should be even'
+    # weights of the closed Newton-Cotes rule with order+1 nodes in [-1, 1]
+    nodes=np.linspace(-1., 1., order+1)
+    powers=np.arange(order+1)
+    w=np.linalg.solve(np.vander(nodes, increasing=True).T, (1.-(-1.)**(powers+1))/(powers+1))
+    u_edges=np.log(np.asarray(edges, dtype=float))
+    Nbins=u_edges.size-1
+    Nevaluations=[0]
+
+    def integrand(u):
+        # a^(slope+4)*function(a) at a=exp(u), with shape u.shape+(...)
+        a=np.exp(u)
+        f=np.asarray(function(a.ravel()))
+        Nevaluations[0]+=a.size
+        f=f.reshape(a.shape+f.shape[1:])
+        return a.reshape(a.shape+(1,)*(f.ndim-a.ndim))**(slope+4.)*f
+
+    def integrals(values, u0, u1):
+        # Newton-Cotes integrals of each interval from the values at its order+1 nodes (axis 1)
+        h=0.5*(u1-u0)
+        return np.einsum('j,ij...->i...', w, values)*h.reshape((-1,)+(1,)*(values.ndim-2))
+
+    # active intervals with their bin, limits and the integrand at their 2*order+1 nodes. The first nodes of all bins are
+    # evaluated together, and the edges shared by neighbouring bins only once
+    ib=np.arange(Nbins)
+    u0=u_edges[:-1]
+    u1=u_edges[1:]
+    u=u0[:,None]+(u1-u0)[:,None]*np.linspace(0., 1., 2*order+1)[None,:]
+    unique, inverse = np.unique(u, return_inverse=True)
+    values=integrand(unique)[inverse.reshape(u.shape)]
+    accepted=np.zeros((Nbins,)+values.shape[2:])
+    accepted_error=np.zeros_like(accepted)
+
+    for iteration in range(max_iter+1):
+        um=0.5*(u0+u1)
+        coarse=integrals(values[:,::2], u0, u1)
+        fine=integrals(values[:,:order+1], u0, um)+integrals(values[:,order:], um, u1)
+        error=np.abs(fine-coarse)
+
+        # totals and estimated errors of each bin
+        total=accepted.copy()
+        total_error=accepted_error.copy()
+        np.add.at(total, ib, fine)
+        np.add.at(total_error, ib, error)
+        scale=np.maximum(np.abs(total), 1.0e-300)
+        errors=np.max((total_error/scale).reshape(Nbins, -1), axis=1)
+
+        # intervals are split if their relative error is larger than the fraction of the tolerance that corresponds to them
+        error_interval=np.max((error/scale[ib]).reshape(ib.size, -1), axis=1)
+        tolerance_interval=rtol*(u1-u0)/(u_edges[ib+1]-u_edges[ib])
+        split=(error_interval>tolerance_interval) & (errors[ib]>rtol)
+        if iteration==max_iter:
+            split[:]=False
+
+        np.add.at(accepted, ib[~split], fine[~split])
+        np.add.at(accepted_error, ib[~split], error[~split])
+        if not np.any(split):
+            break
+        # the halves of the split intervals already have every other node, and only the nodes in between are evaluated
+        old=np.concatenate((values[split,:order+1], values[split,order:]))
+        ib=np.concatenate((ib[split], ib[split]))
+        u0, u1 = np.concatenate((u0[split], um[split])), np.concatenate((um[split], u1[split]))
+        values=np.empty((ib.size, 2*order+1)+old.shape[2:])
+        values[:,::2]=old
+        values[:,1::2]=integrand(u0[:,None]+(u1-u0)[:,None]*(np.arange(order)[None,:]+0.5)/order)
+
+    # normalization by the integral of a^(slope+4)
+    if slope!=-4:
+        norm=(np.exp((slope+4.)*u_edges[1:])-np.exp((slope+4.)*u_edges[:-1]))/(slope+4.)
+    else:
+        norm=u_edges[1:]-u_edges[:-1]
+    return accepted/norm.reshape((Nbins,)+(1,)*(accepted.ndim-1)), errors, Nevaluations[0]
+
+def parallel_map(function, args, workers=1):
+    # returns [function(*arg) for arg in args], evaluated in a pool of processes if workers>1 (workers=None uses all cores)
+    if workers is None:
+        workers=os.cpu_count()
+    if workers==1 or len(args)<2:
+        return [function(*arg) for arg in args]
+    with ProcessPoolExecutor(max_workers=min(workers, len(args))) as executor:
+        return list(executor.map(function, *zip(*args)))
+
+def run_makeopac(a, lnk_file, density, makeopac='./makeopac'):
+    # runs makeopac for a grain size a (um) in its own temporary directory and returns kappa_abs, kappa_sca and g (Nlam,3)
+    material=os.path.basename(lnk_file)[:-4] # makeopac reads <material>.lnk from its working directory
+    tmpdir=tempfile.mkdtemp(prefix='makeopac_')
+    try:
+        os.symlink(os.path.abspath(lnk_file), os.path.join(tmpdir, material+'.lnk'))
+        acm=a*1.0e-4
+        e=round(np.log10(acm))
+        b=acm/(10.0**e)
+        file_inp=open(os.path.join(tmpdir, 'param.inp'),'w')
+        file_inp.write(material+'\n')
+        file_inp.write('%1.5fd%i \n' %(b,e))
+        file_inp.write('%1.5f \n' %density)
+        file_inp.write('1')
+        file_inp.close()
+        subprocess.run([os.path.abspath(makeopac)], cwd=tmpdir, check=True)
+        return np.loadtxt(os.path.join(tmpdir, 'dustkappa_'+material+'.inp'), skiprows=2)[:,1:]
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+def downsample_spectrum(wavelengths, fluxes, lams, dlams, lam_rj=1.0e3):
+    """
+    Mean flux of a high resolution spectrum within each wavelength bin (lams-dlams/2, lams+dlams/2), computed in one pass.
+    Bins at lams>=lam_rj are extrapolated from the last bin below lam_rj following Rayleigh-Jeans (F_lambda propto lambda^-4).
+
+    wavelengths: wavelengths of the spectrum in A (Nmodel)
+    fluxes: spectrum with shape (..., Nmodel), e.g. several spectra sampled at the same wavelengths
+    lams, dlams: wavelength bins in um (Nlam)
+
+    returns the binned spectra with shape (..., Nlam). Empty bins are nan
+    """
+    wavelengths=np.asarray(wavelengths)/1.0e4 # A to um
+    fluxes=np.asarray(fluxes, dtype=float)
+    if np.any(np.diff(wavelengths)<0.):
+        order=np.argsort(wavelengths, kind='stable')
+        wavelengths=wavelengths[order]
+        fluxes=fluxes[...,order]
+    lams=np.asarray(lams)
+    dlams=np.asarray(dlams)
+
+    # points strictly inside each bin are [ilow, ihigh)
+    ilow=np.searchsorted(wavelengths, lams-dlams/2., side='right')
+    ihigh=np.searchsorted(wavelengths, lams+dlams/2., side='left')
+    counts=ihigh-ilow
+    # sums of each bin, padding with a zero so that ihigh can point to the end
+    padded=np.concatenate((fluxes, np.zeros(fluxes.shape[:-1]+(1,))), axis=-1)
+    sums=np.add.reduceat(padded, np.column_stack((ilow, np.maximum(ihigh, ilow))).ravel(), axis=-1)[...,::2]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        spectrum=np.where(counts>0, sums/counts, np.nan)
+
+    # Rayleigh Jeans extrapolation
+    rj=lams>=lam_rj
+    if np.any(rj):
+        i0=np.argmax(rj)
+        if i0>0:
+            spectrum[...,rj]=spectrum[...,i0-1:i0]*(lams[rj]/lams[i0-1])**(-4.)
+        else:
+            spectrum[...,rj]=0.
+    return spectrum
+
 def Intextpol(x,y,xi):
+    # power-law interpolation of y(x) at xi (scalar or array). Below x[0] y[0] is returned, and above x[-1] the last segment is extrapolated.
+    # x must be increasing
 
+    x=np.asarray(x)
+    y=np.asarray(y)
+    xi=np.asarray(xi, dtype=float)
     Nx=len(x)
-    if xi<=x[0]: return y[0] # extrapol                                                                                                                                                                         
-    elif xi<=x[Nx-1]: #interpol                                                                                                                                                                                                              
-        for l in range(1,Nx):
-            if xi<=x[l]:
-                # return y[l-1]+(xi-x[l-1])*(y[l]-y[l-1])/(x[l]-x[l-1])
+    l=np.clip(np.searchsorted(x, xi, side='left'), 1, Nx-1) # first point with xi<=x[l]
+    alpha=np.log(y[l]/y[l-1])/np.log(x[l]/x[l-1])
+    l0=np.where(xi>x[Nx-1], l, l-1) # extrapolation from the last point
+    yi=np.where(xi<=x[0], y[0], y[l0]*(xi/x[l0])**alpha)
+    return yi if yi.ndim else yi[()]
 
-                return y[l-1]*(xi/x[l-1])**(np.log(y[l]/y[l-1])/np.log(x[l]/x[l-1]))
 
-
-    elif xi>x[Nx-1]:    #extrapol                                                                                                                                                                                                            
-        alpha=np.log(y[Nx-1]/y[Nx-2])/np.log(x[Nx-1]/x[Nx-2])
-        return y[Nx-1]*(xi/x[Nx-1])**alpha
+def planck(nu, T):
+    # Planck function B_nu (erg/s/cm2/Hz/ster) at frequencies nu (Hz) and temperatures T (K), broadcast against each other
+    with np.errstate(over='ignore'):
+        return 2.*h_p*nu**3./cc**2./np.expm1(h_p*nu/(K*T))
 
 
 ### functions to manipulate images
@@ -87,7 +552,8 @@ def convert_to_fits(path_image, path_fits, Npixf, dpc, mx=0.0, my=0.0, x0=0.0, y
     # alpha is defined as the spectral index in frequency space, and thus is positive for a typical disc and star at mm wavelengths
     
     ### load image
-    image_in_jypix, nx, ny, nf, lam, pixdeg_x, pixdeg_y = load_image(path_image, dpc, taumap=taumap)
+    # the fits file is saved in single precision, but the continuum subtraction needs double precision
+    image_in_jypix, nx, ny, nf, lam, pixdeg_x, pixdeg_y = load_image(path_image, dpc, taumap=taumap, dtype=np.float64 if continuum_subtraction else np.float32)
     istar, jstar=star_pix(nx, omega)
     
     ## if alpha is given, then disc surface brightness and stellar flux are manipulated
@@ -96,7 +562,7 @@ def convert_to_fits(path_image, path_fits, Npixf, dpc, mx=0.0, my=0.0, x0=0.0, y
         Fstar=image_in_jypix[0,0,jstar,istar]-background # save stellar flux, but subtract background to not include disc.
         ### apply dust spectral index
         image_in_jypix[0,0,jstar,istar]=background
-        image_in_jypix=image_in_jypix*(new_lambda/lam[0])**(-alpha_dust)
+        image_in_jypix*=(new_lambda/lam[0])**(-alpha_dust)
         ### apply star spectral index
         Fstar=Fstar*(new_lambda/lam[0])**(-2.0)
         image_in_jypix[0,0,istar,istar]+=Fstar
@@ -108,7 +574,7 @@ def convert_to_fits(path_image, path_fits, Npixf, dpc, mx=0.0, my=0.0, x0=0.0, y
         Fstar=image_in_jypix[0,0,jstar,istar]-background # save stellar flux, but subtract background to not include disc.
         ### apply dust flux
         image_in_jypix[0,0,jstar,istar]=background
-        image_in_jypix=image_in_jypix*fdisc/np.sum(image_in_jypix)
+        image_in_jypix*=fdisc/np.sum(image_in_jypix)
         ### put back the star
         image_in_jypix[0,0,istar,istar]+=Fstar
         
@@ -121,11 +587,12 @@ def convert_to_fits(path_image, path_fits, Npixf, dpc, mx=0.0, my=0.0, x0=0.0, y
 
     # PAD IMAGE
     image_in_jypix_pad=fpad_image(image_in_jypix, Npixf, Npixf, nx, ny)
+    del image_in_jypix
 
     # add background sources
     if len(background_args) != 0:
         for iback in background_args:
-            image_in_jypix_pad=image_in_jypix_pad + background_object(*iback)
+            image_in_jypix_pad+=background_object(*iback)
 
     ### shift image if necessary
     image_in_jypix_shifted= shift_image(image_in_jypix_pad, mx, my, pixdeg_x, pixdeg_y, omega=omega)
@@ -145,7 +612,7 @@ def convert_to_fits(path_image, path_fits, Npixf, dpc, mx=0.0, my=0.0, x0=0.0, y
             pb=fpad_image(pb, Npixf, Npixf,header_pb['NAXIS1'] , header_pb['NAXIS2'])
 
         # multiply by primary beam and set nans to zero
-        image_in_jypix_shifted=image_in_jypix_shifted*pb
+        image_in_jypix_shifted*=pb
         inans= np.isnan(image_in_jypix_shifted)
         image_in_jypix_shifted[inans]=0.0
         
@@ -283,7 +750,7 @@ def convert_to_fits(path_image, path_fits, Npixf, dpc, mx=0.0, my=0.0, x0=0.0, y
 
     # Make a FITS file!
    
-    image_in_jypix_float=image_in_jypix_shifted.astype(np.float32)
+    image_in_jypix_float=image_in_jypix_shifted.astype(np.float32, copy=False)
     fits.writeto(path_fits, image_in_jypix_float, header, output_verify='fix', overwrite=True)
 
 
@@ -434,26 +901,47 @@ def Convolve_beam_cube(path_image, BMAJ, BMIN, BPA):
 
 
 
-def load_image(path_image, dpc, taumap=False):
-
-    f=open(path_image,'r')
-    iformat=int(f.readline())
-
-    if (iformat < 1) or (iformat > 4):
-        assert False, "ERROR: File format of image not recognized"
-
-    nx, ny = tuple(np.array(f.readline().split(),dtype=int))
-    nf = int(f.readline()) # number of wavelengths
-    sizepix_x, sizepix_y = tuple(np.array(f.readline().split(),dtype=float))
-
-    f.close()
-
-    f=np.loadtxt(path_image, skiprows=4) # empty line is skipped
-
-    lam=f[:nf]
-        
-    image=np.zeros((1,nf,ny,nx), dtype=float)
-    image[0,:,:,:] = f[nf:].reshape(nf, ny, nx)
+def load_image(path_image, dpc, taumap=False, dtype=float):
+    """
+    Load an image or cube made by radmc3d (image.out, or image.bout if radmc3d was run with imageunform) and return
+    it with shape (Nstokes, nf, ny, nx) in Jy/pixel at dpc (pc), or unscaled if taumap. Nstokes is 4 for images
+    with Stokes parameters (iformat 3, stokes option in radmc3d) and 1 otherwise (e.g. iformat 2, local observer). Binary images are memory-mapped and ASCII
+    images are parsed in blocks, so the only full copy of the image in memory is the returned array of type dtype
+    (e.g. np.float32 to halve its size).
+    """
+
+    binary=path_image.endswith('.bout')
+    if binary:
+        iformat, nx, ny, nf = [int(x) for x in np.fromfile(path_image, dtype=np.int64, count=4)]
+        assert iformat>=1 and iformat<=4, "ERROR: File format of image not recognized"
+        Nstokes=4 if iformat==3 else 1
+        f=np.memmap(path_image, dtype=np.float64, mode='r', offset=4*8)
+        sizepix_x, sizepix_y = f[0], f[1]
+        lam=np.array(f[2:2+nf])
+        # the Stokes parameters of each pixel are consecutive, as in ASCII files
+        data=np.moveaxis(f[2+nf:2+nf+Nstokes*nf*ny*nx].reshape(nf, ny, nx, Nstokes), -1, 1)
+    else:
+        f=open(path_image,'rb')
+        iformat=int(f.readline())
+        assert iformat>=1 and iformat<=4, "ERROR: File format of image not recognized"
+        Nstokes=4 if iformat==3 else 1
+        nx, ny = [int(x) for x in f.readline().split()]
+        nf = int(f.readline()) # number of wavelengths
+        sizepix_x, sizepix_y = [float(x) for x in f.readline().split()]
+        numbers=read_ascii_numbers(f) # empty lines are skipped
+        data=np.empty(0)
+
+        def take(count): # next count numbers in the file
+            nonlocal data
+            pieces=[]
+            while count>0:
+                if len(data)==0:
+                    data=next(numbers)
+                pieces.append(data[:count])
+                data=data[len(pieces[-1]):]
+                count-=len(pieces[-1])
+            return np.concatenate(pieces)
+        lam=take(nf)
 
     # Compute the flux in this image as seen at dpc (pc)    
     pixdeg_x = 180.0*(sizepix_x/(dpc*pc))/np.pi
@@ -461,14 +949,20 @@ def load_image(path_image, dpc, taumap=False):
 
     # Compute the conversion factor from erg/cm^2/s/Hz/ster to erg/cm^2/s/Hz/ster at dpc
     pixsurf_ster = pixdeg_x*pixdeg_y * (np.pi/180.)**2
-    factor = 1e+23 * pixsurf_ster
-    # And scale the image array accordingly:
-    image_in_jypix = factor * image
+    factor = 1. if taumap else 1e+23 * pixsurf_ster
 
-    if taumap:
-        return image, nx, ny, nf, lam, pixdeg_x, pixdeg_y
-    else:
-        return image_in_jypix, nx, ny, nf, lam, pixdeg_x, pixdeg_y
+    # fill and scale the image one wavelength at a time
+    image=np.empty((Nstokes,nf,ny,nx), dtype=dtype)
+    for k in range(nf):
+        if binary:
+            channel=data[k,:,:,:]
+        else: # ASCII files have the Stokes parameters of each pixel in the same line
+            channel=take(Nstokes*ny*nx).reshape(ny, nx, Nstokes).transpose(2, 0, 1)
+        np.multiply(channel, factor, out=image[:,k,:,:], casting='unsafe')
+    if not binary:
+        f.close()
+
+    return image, nx, ny, nf, lam, pixdeg_x, pixdeg_y
 
 
 def star_pix(nx, omega):
@@ -500,15 +994,17 @@ def shift_image(image, mx, my, pixdeg_x, pixdeg_y, omega=0.0 ):
     mvx_pix=(mx/(pixdeg_x*3600.0))
     mvy_pix=(my/(pixdeg_y*3600.0))
 
-    shiftVector=(0.0, 0.0, mvy_pix, -mvx_pix) # minus sign as left is positive 
+    shiftVector=(mvy_pix, -mvx_pix) # minus sign as left is positive 
     # cp star and remove it
     istar, jstar=star_pix(len(image[0,0,0,:]), omega)
     Fstar=image[0,0,jstar,istar]
     # replace star with average around it. This is important if there is a disk
     image[0,0,jstar,istar]=np.median([image[0,0,jstar-1,istar], image[0,0,jstar+1,istar], image[0,0,jstar,istar-1], image[0,0,jstar,istar+1]])
     
-    # shift
-    image_shifted=shift(image,shift=shiftVector, order=3)#,mode='wrap')
+    # shift one plane at a time and in place, so a cube is not copied
+    image_shifted=image
+    for index in np.ndindex(image.shape[:-2]):
+        image_shifted[index]=shift(image[index],shift=shiftVector, order=3)#,mode='wrap')
     # # add star in new position
     image_shifted[0,0,jstar+int(round(mvy_pix)),istar-int(round(mvx_pix))]=Fstar
 
@@ -516,16 +1012,17 @@ def shift_image(image, mx, my, pixdeg_x, pixdeg_y, omega=0.0 ):
 
 def fpad_image(image_in, pad_x, pad_y, nx, ny):
 
+    # pads the last two axes (e.g. all the wavelengths of a cube)
     if image_in.shape[-2:] != (pad_x,pad_y):
-        pad_image = np.zeros((1,1,pad_x,pad_y))
+        pad_image = np.zeros(image_in.shape[:-2]+(pad_y,pad_x), dtype=image_in.dtype)
         if nx%2==0 and ny%2==0: # even number of pixels
-            pad_image[0,0,
+            pad_image[...,
                       pad_y//2-ny//2:pad_y//2+ny//2,
-                      pad_x//2-nx//2:pad_x//2+nx//2] = image_in[0,0,:,:]
+                      pad_x//2-nx//2:pad_x//2+nx//2] = image_in[...,:,:]
         else:                  # odd number of pixels
-            pad_image[0,0,
+            pad_image[...,
                       pad_y//2-(ny-1)//2:pad_y//2+(ny+1)//2,
-                      pad_x//2-(nx-1)//2:pad_x//2+(nx+1)//2] = image_in[0,0,:,:]
+                      pad_x//2-(nx-1)//2:pad_x//2+(nx+1)//2] = image_in[...,:,:]
         return pad_image
 
     else:                      # padding is not necessary as image is already the right size (potential bug if nx>pad_x)
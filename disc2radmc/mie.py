@@ -0,0 +1,337 @@
+################################################################################
+## Mie theory to compute dust opacities. Vectorized version of the Bohren & Huffman code bhmie.f (adapted by B.T. Draine) ###
+################################################################################
+
+import numpy as np
+from scipy.linalg.lapack import dtbtrs, ztbtrs
+from scipy.sparse import csc_matrix
+
+
+def three_term_recurrence(c1, c2, z_1, z0, lengths):
+    """
+    Runs the recurrences z_j=c1_j*z_{j-1}+c2_j*z_{j-2} (j=1...L) of several sequences at once in compiled code, writing them as
+    one banded lower triangular system that is solved by LAPACK (?tbtrs), which is the same forward substitution.
+
+    c1, c2: coefficients of all the sequences one after the other (sum(lengths))
+    z_1, z0: z_{-1} and z_0 of each sequence, with shape (Nseq,) or (Nseq, Nrhs) to run several recurrences with the same coefficients
+    lengths: number of terms of each sequence (>0)
+
+    returns z_1...z_L of all the sequences one after the other, with shape (sum(lengths),) or (sum(lengths), Nrhs)
+    """
+    lengths=np.asarray(lengths)
+    N=int(np.sum(lengths))
+    dtype=np.result_type(c1, c2, z_1, z0, float)
+    c1=np.broadcast_to(np.asarray(c1, dtype=dtype), (N,))
+    c2=np.broadcast_to(np.asarray(c2, dtype=dtype), (N,))
+    z_1=np.asarray(z_1, dtype=dtype)
+    z0=np.asarray(z0, dtype=dtype)
+    vector=z0.ndim==1
+    if vector:
+        z_1=z_1[:,None]
+        z0=z0[:,None]
+    starts=np.concatenate(([0], np.cumsum(lengths)[:-1]))
+
+    # band of the matrix with unit diagonal: ab[1,j]=A[j+1,j] and ab[2,j]=A[j+2,j]. Terms of different sequences are not coupled
+    ab=np.zeros((3, N), dtype=dtype)
+    ab[1,:-1]=-c1[1:]
+    ab[2,:-2]=-c2[2:]
+    ab[1,starts[1:]-1]=0.
+    ab[2,starts[1:]-1]=0.
+    ab[2,starts[starts>=2]-2]=0.
+
+    # the initial values of each sequence go to the right hand side
+    b=np.zeros((N, z0.shape[1]), dtype=dtype)
+    b[starts]=c1[starts,None]*z0+c2[starts,None]*z_1
+    second=starts[lengths>1]+1
+    b[second]+=c2[second,None]*z0[lengths>1]
+    z, info = (ztbtrs if dtype==complex else dtbtrs)(ab, b, uplo='L', diag='U', overwrite_b=1)
+    assert info==0, 'banded solver failed (info=%i)'%info
+    return z[:,0] if vector else z
+
+
+def logarithmic_derivative(y, nstop, nmx, block_size=1024):
+    """
+    Logarithmic derivatives D_n(y)=psi_n'(y)/psi_n(y) for n=1...nstop of each point, one point after the other. As in bhmie.f, the
+    recurrence starts with D_nmx=0 and runs downward, which is done here for psi_n(y) (whose ratios give D_n). psi_n(y) can grow by
+    many orders of magnitude, so it is computed in blocks (of at most block_size orders and a growth below 1e250) normalized after
+    each block.
+    """
+    Np=y.size
+    starts=np.concatenate(([0], np.cumsum(nstop)[:-1]))
+    D=np.zeros(int(np.sum(nstop)), dtype=complex)
+    # w_n is proportional to psi_n(y): w_nmx=1 and w_nmx-1=nmx/y so that D_nmx=0. carry holds w_top+2 and w_top+1
+    top=nmx-2
+    carry2=np.ones(Np, dtype=complex)
+    carry1=nmx/y
+
+    nhi=int(np.max(top))
+    while nhi>=0:
+        # |w_n/w_n+1|<=(2n+3)/|y|+1
+        ymin=np.min(np.abs(y[top>=nhi-block_size+1]))
+        growth=np.cumsum(np.log10((2.*np.arange(nhi, max(nhi-block_size, -1), -1)+3.)/ymin+1.))
+        nlo=max(nhi-max(np.searchsorted(growth, 250., side='right'), 1)+1, 0)
+        active=np.nonzero(top>=nlo)[0]
+        tops=np.minimum(top[active], nhi)
+        L=tops-nlo+1
+        segment_starts=np.concatenate(([0], np.cumsum(L)[:-1]))
+        point=np.repeat(np.arange(active.size), L)
+        n=(tops[point]-(np.arange(L.sum())-segment_starts[point])).astype(float) # w_n computed from w_n+1 and w_n+2
+        ya=y[active][point]
+        w=three_term_recurrence((2.*n+3.)/ya, -1., carry2[active], carry1[active], L)
+
+        # D_n+1=w_n/w_n+1-(n+1)/y
+        w1=np.empty_like(w)
+        w1[1:]=w[:-1]
+        w1[segment_starts]=carry1[active]
+        keep=n+1<=nstop[active][point]
+        D[starts[active][point][keep]+n[keep].astype(int)]=(w/w1-(n+1.)/ya)[keep]
+
+        # w_nlo+1 and w_nlo, normalized
+        last=segment_starts+L-1
+        new1=w[last]
+        new2=np.where(L>1, w[np.maximum(last-1, 0)], carry1[active])
+        scale=np.maximum(np.abs(new1), np.abs(new2))
+        carry1[active]=new1/scale
+        carry2[active]=new2/scale
+        top[active]=nlo-1
+        nhi=nlo-1
+    return D
+
+
+def mie_series(x, refrel, nstop, nmx, amu=None, block_size=2**22):
+    # efficiencies (and amplitudes at the angles with cosines amu) of points with size parameters x and refractive indices refrel,
+    # summing the terms n=1...nstop of all points at once. See bhmie
+    Np=x.size
+    starts=np.concatenate(([0], np.cumsum(nstop)[:-1]))
+    point=np.repeat(np.arange(Np), nstop)
+    n=(np.arange(point.size)-starts[point]+1).astype(float)
+    xp=x[point]
+    mp=refrel[point]
+
+    D=logarithmic_derivative(x*refrel, nstop, nmx)
+
+    # Riccati-Bessel functions psi_n(x) and chi_n(x) by upward recurrence from psi_-1=cos(x), psi_0=sin(x), chi_-1=-sin(x), chi_0=cos(x)
+    z=three_term_recurrence((2.*n-1.)/xp, -1., np.column_stack((np.cos(x), -np.sin(x))), np.column_stack((np.sin(x), np.cos(x))), nstop)
+    psi=z[:,0]
+    chi=z[:,1]
+    psi1=np.empty_like(psi) # psi_n-1
+    psi1[1:]=psi[:-1]
+    psi1[starts]=np.sin(x)
+    chi1=np.empty_like(chi)
+    chi1[1:]=chi[:-1]
+    chi1[starts]=np.cos(x)
+    xi=psi-1j*chi
+    xi1=psi1-1j*chi1
+
+    t=D/mp+n/xp
+    an=(t*psi-psi1)/(t*xi-xi1)
+    t=mp*D+n/xp
+    bn=(t*psi-psi1)/(t*xi-xi1)
+    del D, z, psi, chi, psi1, chi1, xi, xi1, t
+
+    fn=(2.*n+1.)/(n*(n+1.))
+    qsca=np.add.reduceat((2.*n+1.)*(np.abs(an)**2+np.abs(bn)**2), starts)
+    g=fn*(an.real*bn.real+an.imag*bn.imag)
+    # terms with a_n-1 and b_n-1, which are 0 for n=1
+    g[1:]+=((n[1:]-1.)*(n[1:]+1.)/n[1:])*(an[:-1].real*an[1:].real+an[:-1].imag*an[1:].imag+bn[:-1].real*bn[1:].real+bn[:-1].imag*bn[1:].imag)
+    gsca=np.add.reduceat(g, starts)
+    sext=np.add.reduceat((n+0.5)*(an+bn), starts) # S1 at 0 deg
+    sback=np.add.reduceat(np.where(n%2==1., 1., -1.)*(n+0.5)*(an-bn), starts) # S1 at 180 deg
+
+    gsca=2.*gsca/qsca
+    qsca=(2./x**2)*qsca
+    qext=(4./x**2)*sext.real
+    qback=(np.abs(sback)/x)**2/np.pi
+    if amu is None:
+        return qext, qsca, qback, gsca
+
+    # S1=sum_n fn*(an*pi_n+bn*tau_n) and S2=sum_n fn*(an*tau_n+bn*pi_n), with the angular functions computed in blocks of n
+    Nmax=int(np.max(nstop))
+    A=csc_matrix((fn*an, (point, n.astype(int)-1)), shape=(Np, Nmax))
+    B=csc_matrix((fn*bn, (point, n.astype(int)-1)), shape=(Np, Nmax))
+    S1=np.zeros((Np, amu.size), dtype=complex)
+    S2=np.zeros((Np, amu.size), dtype=complex)
+    Nblock=max(1, block_size//amu.size)
+    pi0=np.zeros(amu.size) # pi_n-1 and pi_n before the block
+    pi1=np.ones(amu.size)
+    for n0 in range(1, Nmax+1, Nblock):
+        nb=np.arange(n0, min(n0+Nblock, Nmax+1), dtype=float)
+        if n0==1: # pi_1=1 and pi_n=((2n-1)/(n-1))*mu*pi_n-1-(n/(n-1))*pi_n-2
+            pi=np.ones((nb.size, amu.size))
+            if nb.size>1:
+                m=nb[1:,None]
+                pi[1:]=three_term_recurrence((((2.*m-1.)/(m-1.))*amu[None,:]).T.ravel(), np.broadcast_to((-m/(m-1.)), (nb.size-1, amu.size)).T.ravel(), pi0, pi1, np.full(amu.size, nb.size-1)).reshape(amu.size, -1).T
+            previous=np.vstack((pi0[None,:], pi[:-1]))
+        else:
+            m=nb[:,None]
+            pi=three_term_recurrence((((2.*m-1.)/(m-1.))*amu[None,:]).T.ravel(), np.broadcast_to((-m/(m-1.)), (nb.size, amu.size)).T.ravel(), pi0, pi1, np.full(amu.size, nb.size)).reshape(amu.size, -1).T
+            previous=np.vstack((pi1[None,:], pi[:-1]))
+        tau=nb[:,None]*amu[None,:]*pi-(nb[:,None]+1.)*previous
+        Ab=A[:,n0-1:n0-1+nb.size]
+        Bb=B[:,n0-1:n0-1+nb.size]
+        S1+=Ab@pi+Bb@tau
+        S2+=Ab@tau+Bb@pi
+        pi0=previous[-1]
+        pi1=pi[-1]
+    return qext, qsca, qback, gsca, S1, S2
+
+
+def bhmie(x, refrel, nang=0, theta=None, chunk_size=2**21):
+    """
+    Mie efficiencies of spheres computed for many size parameters and refractive indices at once.
+    This follows opacities/Mie/bhmie.f, but the recurrences of all the terms of the series run in compiled code (see
+    three_term_recurrence) and the terms are summed with vectorized operations, so no Python loop runs over the terms.
+
+    x: size parameters 2*pi*a/lambda (any shape)
+    refrel: complex refractive index relative to the surrounding medium (broadcastable to x)
+    nang: number of angles between 0 and 90 deg (including both). If nang>1, the scattering amplitudes
+          S1 and S2 are also returned at 2*nang-1 angles from 0 to 180 deg
+    theta: scattering angles in deg where S1 and S2 are returned instead (any grid between 0 and 180 deg)
+    chunk_size: points are processed in groups with about chunk_size terms in total to limit memory usage
+
+    returns qext, qsca, qback, gsca (and S1, S2 with shapes x.shape+(Nang,) if nang>1 or theta is given)
+    """
+
+    x, refrel = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(refrel, dtype=complex))
+    shape=x.shape
+    x=x.ravel()
+    refrel=refrel.ravel()
+    Np=x.size
+
+    xstop=x+4.*x**(1./3.)+2.
+    nstop=xstop.astype(int)
+    # bhmie.f starts the recurrence of D_n at max(xstop, |mx|)+15, which gives errors ~1e-3 for |mx|>~1e3
+    nmx=(np.maximum(xstop, np.abs(x*refrel))+15.+4.*np.abs(x*refrel)**(1./3.)).astype(int)
+
+    if theta is None and nang>1:
+        theta=np.linspace(0., 180., 2*nang-1)
+    amplitudes=theta is not None
+    amu=np.cos(np.deg2rad(np.asarray(theta, dtype=float))).ravel() if amplitudes else None
+
+    # points with similar numbers of terms are processed together
+    order=np.argsort(-nmx, kind='stable')
+    results=[np.zeros(Np) for i in range(4)]
+    if amplitudes:
+        results+=[np.zeros((Np, amu.size), dtype=complex) for i in range(2)]
+    cumulative=np.cumsum(nstop[order])
+    i0=0
+    while i0<Np:
+        i1=max(i0+1, np.searchsorted(cumulative, (cumulative[i0-1] if i0>0 else 0)+chunk_size, side='right'))
+        chunk=order[i0:i1]
+        for result, values in zip(results, mie_series(x[chunk], refrel[chunk], nstop[chunk], nmx[chunk], amu=amu)):
+            result[chunk]=values
+        i0=i1
+
+    results=[result.reshape(shape+result.shape[1:]) for result in results]
+    return tuple(results)
+
+
+def qabs_adt(w):
+    # absorption efficiency in the anomalous diffraction approximation (van de Hulst 1957) with w=4*k*x
+    w=np.asarray(w, dtype=float)
+    small=w<1.0e-3
+    ws=np.where(small, 1., w)
+    return np.where(small, 2.*w/3.-w**2/3., 1.+2.*np.exp(-ws)/ws+2.*(np.exp(-ws)-1.)/ws**2)
+
+
+def scattering_matrix_elements(S1, S2):
+    # Z11, Z12, Z22, Z33, Z34, Z44 of spheres (in units of |S|^2, Bohren & Huffman 1983) in the last axis
+    S11=0.5*(np.abs(S2)**2+np.abs(S1)**2)
+    S12=0.5*(np.abs(S2)**2-np.abs(S1)**2)
+    S33=(S2*np.conj(S1)).real
+    S34=(S2*np.conj(S1)).imag
+    return np.stack((S11, S12, S11, S33, S34, S33), axis=-1)
+
+
+def mie_opacities(a, lams, refrel, density, xmax=None, theta=None):
+    """
+    Absorption and scattering opacities (cm2/g) and asymmetry parameter of spheres, as computed by makeopac.
+
+    a: grain sizes in um (Na)
+    lams: wavelengths in um (Nlam)
+    refrel: complex refractive index at lams (Nlam)
+    density: grain density in g/cm3
+    xmax: if None (default), the full Mie series is evaluated for all grains, as in bhmie.f (slow for x>>1e4, e.g. mm-cm
+          grains at UV-optical wavelengths). If given (e.g. 1e4), grains with larger size parameters use the efficiencies
+          at xmax, with Qabs scaled following the anomalous diffraction approximation to account for the longer absorption
+          path. This approximation is within ~0.5% of Mie for absorbing grains, but Qabs can be wrong by up to ~20% for
+          nearly transparent materials such as water ice.
+    theta: if given, scattering angles (deg) where the scattering matrix is also computed. For grains with x>xmax
+           the angular dependence at xmax is used, normalized to kappa_sca
+
+    returns kappa_abs, kappa_sca and g with shapes (Na, Nlam), and the scattering matrix Z (Z11, Z12, Z22, Z33, Z34, Z44)
+    in cm2/g/ster with shape (Na, Nlam, Nang, 6) if theta is given
+    """
+
+    a=np.atleast_1d(np.asarray(a, dtype=float))
+    lams=np.atleast_1d(np.asarray(lams, dtype=float))
+    refrel=np.broadcast_to(np.asarray(refrel, dtype=complex), lams.shape)
+    x=2.*np.pi*a[:,None]/lams[None,:]
+    m=np.broadcast_to(refrel[None,:], x.shape)
+
+    qext=np.zeros(x.shape)
+    qsca=np.zeros(x.shape)
+    gsca=np.zeros(x.shape)
+    if theta is not None:
+        # scattering matrix divided by pi*x**2*qsca, which integrates to 1 over the sphere
+        Zn=np.zeros(x.shape+(len(theta), 6))
+
+    large=np.zeros(x.shape, dtype=bool) if xmax is None else x>xmax
+    results=bhmie(x[~large], m[~large], theta=theta)
+    qext[~large], qsca[~large], qback, gsca[~large] = results[:4]
+    if theta is not None:
+        Zn[~large]=scattering_matrix_elements(*results[4:])/(np.pi*x[~large]**2*qsca[~large])[:,None,None]
+
+    if np.any(large):
+        # efficiencies at xmax for each wavelength
+        results=bhmie(np.full(lams.shape, xmax), refrel, theta=theta)
+        qext_max, qsca_max, qback_max, gsca_max = results[:4]
+        qabs_max=qext_max-qsca_max
+        ilam=np.nonzero(large)[1]
+        k=refrel.imag[ilam]
+        qabs=qabs_max[ilam]*qabs_adt(4.*k*x[large])/np.where(k>0., qabs_adt(4.*k*xmax), 1.)
+        qext[large]=qext_max[ilam]
+        qsca[large]=qext_max[ilam]-qabs
+        gsca[large]=gsca_max[ilam]
+        if theta is not None:
+            Zn[large]=(scattering_matrix_elements(*results[4:])/(np.pi*xmax**2*qsca_max)[:,None,None])[ilam]
+
+    # Q*sigma_geometric/m_grain
+    factor=3./(4.*density*a[:,None]*1.0e-4)
+    if theta is not None:
+        return (qext-qsca)*factor, qsca*factor, gsca, Zn*(qsca*factor)[:,:,None,None]
+    return (qext-qsca)*factor, qsca*factor, gsca
+
+
+def size_averaged_mie_opacities(a, weights, lams, refrel, density, xmax=None, theta=None):
+    # mie_opacities averaged over the sizes a with (normalized) weights. Returns kappa_abs, kappa_sca and g with shape (Nlam),
+    # and Z with shape (Nlam, Nang, 6) if theta is given
+    return tuple(np.tensordot(weights, result, axes=(0,0)) for result in mie_opacities(a, lams, refrel, density, xmax=xmax, theta=theta))
+
+
+def chop_forward_peak(theta, Z, chop):
+    """
+    Removes the forward-scattering peak of a scattering matrix at angles smaller than chop (deg) by setting Z at those angles
+    to its value at chop. The light scattered into the peak is treated as not scattered, i.e. kappa_sca and g are recomputed from the
+    chopped Z. This avoids peaks too narrow to be resolved by the angle grid (as in makedustopac.py of radmc3d)
+
+    theta: scattering angles (deg) increasing from 0 to 180
+    Z: scattering matrix with shape (..., Nang, 6)
+
+    returns Z, kappa_sca and g
+    """
+    Z=np.array(Z)
+    ichop=np.searchsorted(theta, chop)
+    Z[...,:ichop,:]=Z[...,ichop:ichop+1,:]
+    ksca, g = integrate_scattering_matrix(theta, Z)
+    return Z, ksca, g
+
+
+def integrate_scattering_matrix(theta, Z):
+    # kappa_sca and g obtained integrating Z11 over the angle grid theta (trapezoidal rule in cos(theta))
+    mu=np.cos(np.deg2rad(theta))
+    dmu=-np.diff(mu)
+    Z11=Z[...,0]
+    ksca=2.*np.pi*np.sum(0.5*(Z11[...,1:]+Z11[...,:-1])*dmu, axis=-1)
+    g=2.*np.pi*np.sum(0.5*(Z11[...,1:]*mu[1:]+Z11[...,:-1]*mu[:-1])*dmu, axis=-1)/ksca
+    return ksca, g
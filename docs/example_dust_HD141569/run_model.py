@@ -137,6 +137,7 @@ dust=disc2radmc.dust(lammodel,
 # Compute dust opaicties with Mie theory only if you have changed the size distribution parameters or optical constants.
 # It requires having the file makeopac in the same working directory. 
 # makeopac can be found and compiled from files at https://github.com/SebaMarino/disc2radmc/tree/main/opacities/Mie
+# Alternatively, compute_opacities(mie_code='python') uses the Mie code included in disc2radmc, which is slower for large grains.
 # dust.compute_opacities()
 
 ### DUST DENSITY DISTRIBUTION (this needs to be every time the spatial distribution or total masses are changed)
@@ -0,0 +1,12 @@
+import os
+import sys
+import pytest
+
+
+@pytest.fixture
+def radmc3d(tmp_path):
+    # executable running the radmc3d stand-in (tests/radmc3d_standin.py) with the python running the tests
+    path=tmp_path/'radmc3d'
+    path.write_text('#!/bin/sh\nexec "%s" "%s" "$@"\n'%(sys.executable, os.path.join(os.path.dirname(__file__), 'radmc3d_standin.py')))
+    path.chmod(0o755)
+    return str(path)
@@ -0,0 +1,116 @@
+"""
+A stand-in for radmc3d used by the tests. It understands a small subset of the radmc3d commands and writes outputs with
+the same format as radmc3d, without any radiative transfer:
+    image ... npix N (lambda L | loadlambda) sizeau S [imageunform]: image.out (or image.bout) with every pixel equal to the wavelength
+    spectrum loadlambda ...: spectrum.out with the flux equal to the wavelength
+    mctherm: dust_temperature.dat
+    fail: writes an error message and exits with code 1
+    child: child mode, reading the commands from stdin (see child)
+The arguments, the contents of radmc3d.inp and the time when it started and finished (after sleeping RADMC3D_STANDIN_SLEEP s)
+are written to stdout, and the working directory to cwd.txt.
+"""
+
+import os
+import sys
+import time
+
+au=1.49597870700e13
+
+
+def value(args, name, default=None):
+    return args[args.index(name)+1] if name in args else default
+
+
+def read_wavelengths():
+    with open('camera_wavelength_micron.inp', 'r') as file_wavelengths:
+        values=file_wavelengths.read().split()
+    return [float(x) for x in values[1:1+int(values[0])]]
+
+
+def image_text(args):
+    # image.out with every pixel equal to the wavelength
+    npix=int(float(value(args, 'npix', 100)))
+    lams=read_wavelengths() if 'loadlambda' in args else [float(value(args, 'lambda', 880.))]
+    sizepix=float(value(args, 'sizeau', 100.))*au/npix
+    text='1\n%d %d\n%d\n%.17g %.17g\n'%(npix, npix, len(lams), sizepix, sizepix)
+    text+=''.join('%.17g\n'%lam for lam in lams)+'\n'
+    for lam in lams:
+        text+='%.17g\n'%lam*(npix*npix)+'\n'
+    return text
+
+
+def spectrum_text():
+    # spectrum.out with the flux equal to the wavelength
+    lams=read_wavelengths()
+    return '1\n%d\n\n'%len(lams)+''.join('%.17g %.17g\n'%(lam, lam) for lam in lams)
+
+
+def write_image(args):
+    if 'imageunform' in args:
+        import numpy as np
+        values=np.array(image_text(args).split(), dtype=float)
+        with open('image.bout', 'wb') as file_image:
+            values[:4].astype(np.int64).tofile(file_image)
+            values[4:].tofile(file_image)
+    else:
+        with open('image.out', 'w') as file_image:
+            file_image.write(image_text(args))
+
+
+def write_spectrum():
+    with open('spectrum.out', 'w') as file_spectrum:
+        file_spectrum.write(spectrum_text())
+
+
+def child():
+    # child mode: arguments are read one per line until enter, and the last image or spectrum is written to stdout
+    # with writeimage or writespectrum. crash exits without answering
+    args=[]
+    outputs={}
+    for line in sys.stdin:
+        line=line.strip()
+        if line=='enter':
+            if args[0]=='image':
+                outputs['image']=image_text(args)
+            elif args[0]=='spectrum':
+                outputs['spectrum']=spectrum_text()
+            args=[]
+        elif line in ('writeimage', 'writespectrum'):
+            sys.stdout.write(outputs[line[5:]])
+            sys.stdout.flush()
+        elif line=='quit':
+            return
+        elif line=='crash':
+            sys.exit(3)
+        else:
+            args.append(line)
+
+
+def main(args):
+    if args[0]=='child':
+        child()
+        return
+    print(' '.join(args))
+    if os.path.exists('radmc3d.inp'):
+        with open('radmc3d.inp', 'r') as file_radmc3d:
+            print(file_radmc3d.read())
+    with open('cwd.txt', 'w') as file_cwd:
+        file_cwd.write(os.getcwd())
+    start=time.time()
+    time.sleep(float(os.environ.get('RADMC3D_STANDIN_SLEEP', 0.)))
+    print('running from %r to %r'%(start, time.time()))
+
+    if args[0]=='image':
+        write_image(args)
+    elif args[0]=='spectrum':
+        write_spectrum()
+    elif args[0]=='mctherm':
+        with open('dust_temperature.dat', 'w') as file_temperature:
+            file_temperature.write('1\n1\n1\n10.0\n')
+    elif args[0]=='fail':
+        print('ERROR: stand-in failure', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__=='__main__':
+    main(sys.argv[1:])
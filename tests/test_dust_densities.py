@@ -0,0 +1,72 @@
+import os
+import numpy as np
+import pytest
+from disc2radmc.constants import au, M_earth
+from disc2radmc.functions_misc import read_radmc3d_field
+from disc2radmc.model import workspace, wavelength_grid, physical_grid, dust
+
+lnk_file=os.path.join(os.path.dirname(__file__), '..', 'opacities', 'dust_optical_constants', 'Sil_0.1_10000.lnk')
+
+
+def make_dust(tmp_path, mirror=True):
+    model=workspace(str(tmp_path/'model'))
+    lam_grid=wavelength_grid(lammin=1., lammax=1000., Nlam=3, workspace=model)
+    grid=physical_grid(Nr=8, Nphi=6, Nth=5, rmin=10., rmax=100., thmax=0.3, mirror=mirror, workspace=model)
+    return dust(lam_grid, Mdust=0.1, amin=1., amax=1000., N_species=3, lnk_file=lnk_file, tag='sil', workspace=model), grid
+
+
+def sigma_sizes(rho, phi, a, r0, width):
+    # ring whose width depends on the grain size (a can be an array of sizes broadcast against rho)
+    return np.exp(-0.5*((rho-r0)/(width*(1.+np.log10(a))))**2)
+
+
+def sigma_size(rho, phi, a, r0, width):
+    # the same for a single size at a time
+    return sigma_sizes(rho, phi, float(a), r0, width)
+
+
+def test_density_paths(tmp_path):
+    # batched sizes, sizes one at a time, a single phi slice and groups of phi slices stored in a memory map give the same density
+    dust_i, grid = make_dust(tmp_path)
+    arguments=dict(grid=grid, par_sigma=(50., 10.), h=0.05, r0=50., size_segregation=True, beta=-0.5)
+    densities=[]
+    for function_sigma, options in [(sigma_sizes, {}), (sigma_size, {}), (sigma_sizes, dict(axisymmetric=True)), (sigma_sizes, dict(max_memory=8*8*3*grid.Nth*grid.Nr*2))]:
+        dust_i.dust_densities(function_sigma=function_sigma, **arguments, **options)
+        densities.append(np.array(dust_i.dens_d))
+    assert isinstance(dust_i.dens_d, np.memmap) and os.path.exists(dust_i.workspace.path('dust_density.npy'))
+    for dens in densities[1:]:
+        assert np.allclose(dens, densities[0], rtol=1.0e-12, atol=0.)
+
+    # each species has the mass of its bin (both emispheres), and larger grains are more settled
+    mass=2.*np.einsum('sijk,ijk->s', densities[0], grid.dV)*au**3
+    assert np.allclose(mass, dust_i.Mgrid*M_earth, rtol=1.0e-12)
+    assert np.all(np.diff(densities[0][:,0,0,:].sum(axis=-1))>0.)
+
+
+@pytest.mark.parametrize('mirror', [True, False])
+def test_write_density(tmp_path, mirror):
+    # binary header (iformat, precision, Ncells, Nspecies) and radmc3d order: r runs fastest, then theta from the N pole
+    # (to the S pole if mirror=False), then phi. The ASCII file has the same values
+    dust_i, grid = make_dust(tmp_path, mirror=mirror)
+    for axisymmetric in [False, True]:
+        dust_i.dust_densities(grid=grid, function_sigma=lambda rho, phi, r0: np.exp(-0.5*((rho-r0)/10.)**2)*(1.+0.5*np.cos(phi)*(not axisymmetric)), par_sigma=(50.,), axisymmetric=axisymmetric)
+        Ncells=grid.Nr*grid.Nphi*grid.Nth*(1 if mirror else 2)
+        assert grid.Ncells==Ncells
+
+        dust_i.write_density(binary=True)
+        header=np.fromfile(dust_i.workspace.path('dust_density.binp'), dtype=np.int64, count=4)
+        assert np.array_equal(header, [1, 8, Ncells, 3])
+        assert os.path.getsize(dust_i.workspace.path('dust_density.binp'))==4*8+3*Ncells*8
+        values=np.fromfile(dust_i.workspace.path('dust_density.binp'), dtype=np.float64, offset=4*8).reshape(3, grid.Nphi, -1, grid.Nr)
+        dens=np.array(dust_i.dens_d)
+        for k in range(grid.Nphi):
+            for j in range(grid.Nth):
+                assert np.array_equal(values[:,k,j,:], dens[:,grid.Nth-1-j,k,:]) # northern emisphere
+                if not mirror:
+                    assert np.array_equal(values[:,k,grid.Nth+j,:], dens[:,j,k,:]) # southern emisphere
+        assert not os.path.exists(dust_i.workspace.path('dust_density.inp'))
+
+        dust_i.write_density(binary=False)
+        assert not os.path.exists(dust_i.workspace.path('dust_density.binp'))
+        ascii=read_radmc3d_field(dust_i.workspace.path('dust_density.inp'))
+        assert np.array_equal(ascii, values.reshape(3, Ncells))
@@ -0,0 +1,50 @@
+import numpy as np
+from disc2radmc.functions_misc import load_image
+
+
+def write_stokes_images(directory, image, lams, sizepix=1.5e13):
+    # write image (4, nf, ny, nx) as radmc3d does, with the 4 Stokes parameters of each pixel consecutive
+    nf, ny, nx = image.shape[1:]
+    pixels=np.moveaxis(image, 0, -1) # nf, ny, nx, 4
+    path_ascii=str(directory/'image.out')
+    with open(path_ascii, 'w') as f:
+        f.write('3\n%d %d\n%d\n%.17g %.17g\n'%(nx, ny, nf, sizepix, sizepix))
+        f.write(''.join('%.17g\n'%lam for lam in lams)+'\n')
+        for k in range(nf):
+            f.write(''.join(' '.join('%.17g'%v for v in pixel)+'\n' for pixel in pixels[k].reshape(-1, 4))+'\n')
+    path_binary=str(directory/'image.bout')
+    with open(path_binary, 'wb') as f:
+        np.array([3, nx, ny, nf], dtype=np.int64).tofile(f)
+        np.concatenate(([sizepix, sizepix], lams, pixels.ravel())).tofile(f)
+    return path_ascii, path_binary
+
+
+def test_stokes_round_trip(tmp_path):
+    image=np.arange(4*2*2*3, dtype=float).reshape(4, 2, 2, 3)+1. # Stokes, nf=2, ny=2, nx=3
+    lams=np.array([880., 1300.])
+    for path in write_stokes_images(tmp_path, image, lams):
+        loaded, nx, ny, nf, lam, pixdeg_x, pixdeg_y = load_image(path, 100., taumap=True)
+        assert (nx, ny, nf)==(3, 2, 2)
+        assert np.array_equal(lam, lams)
+        assert np.array_equal(loaded, image)
+
+
+def test_local_observer_image(tmp_path):
+    # iformat 2 (local observer) images have a single intensity per pixel, as iformat 1
+    image=np.arange(2*2*3, dtype=float).reshape(2, 2, 3)+1. # nf=2, ny=2, nx=3
+    lams=np.array([880., 1300.])
+    path_ascii=str(tmp_path/'image.out')
+    with open(path_ascii, 'w') as f:
+        f.write('2\n3 2\n2\n1.5e13 1.5e13\n')
+        f.write(''.join('%.17g\n'%lam for lam in lams)+'\n')
+        for k in range(2):
+            f.write(''.join('%.17g\n'%v for v in image[k].ravel())+'\n')
+    path_binary=str(tmp_path/'image.bout')
+    with open(path_binary, 'wb') as f:
+        np.array([2, 3, 2, 2], dtype=np.int64).tofile(f)
+        np.concatenate(([1.5e13, 1.5e13], lams, image.ravel())).tofile(f)
+    for path in (path_ascii, path_binary):
+        loaded, nx, ny, nf, lam, pixdeg_x, pixdeg_y = load_image(path, 100., taumap=True)
+        assert (nx, ny, nf)==(3, 2, 2)
+        assert np.array_equal(lam, lams)
+        assert np.array_equal(loaded, image[None])
@@ -0,0 +1,41 @@
+import numpy as np
+from disc2radmc.mie import bhmie, mie_opacities
+
+
+def test_bhmie_reference():
+    # example of Bohren & Huffman (appendix A): sphere of radius 0.525 um and refractive index 1.55 at 0.6328 um
+    x=2.*np.pi*0.525/0.6328
+    qext, qsca, qback, gsca, S1, S2 = bhmie(x, 1.55+0.j, nang=11)
+    assert np.isclose(qext, 3.10543, atol=1.0e-5) and np.isclose(qsca, 3.10543, atol=1.0e-5)
+    assert np.isclose(qback, 0.23279, atol=1.0e-5) and np.isclose(gsca, 0.63314, atol=1.0e-5)
+    # forward amplitudes give qext, backward ones qback
+    assert np.isclose(S1[0], S2[0]) and np.isclose(4.*S1[0].real/x**2, qext)
+    assert np.isclose(4.*np.abs(S1[-1])**2/x**2/(4.*np.pi), qback)
+
+
+def test_bhmie_batches():
+    # points computed together (and in several chunks) agree with points computed one by one
+    rng=np.random.default_rng(0)
+    x=10.**rng.uniform(-3., 3., 40)
+    m=rng.uniform(1.1, 3., 40)+1.j*10.**rng.uniform(-5., 0., 40)
+    theta=np.linspace(0., 180., 7)
+    together=bhmie(x, m, theta=theta, chunk_size=2000)
+    for i in range(x.size):
+        for value, single in zip(together, bhmie(x[i], m[i], theta=theta)):
+            assert np.allclose(value[i], single, rtol=1.0e-10, atol=0.)
+
+
+def test_mie_opacities_makeopac():
+    # kappa_abs, kappa_sca and g (cm2/g) computed by makeopac (single precision) for silicate grains of 1, 30 and 1000 um with
+    # density 3 g/cm3, at 0.5, 2, 10, 100 and 1000 um
+    lams=np.array([0.5, 2., 10., 100., 1000.])
+    refrel=np.array([1.6931+0.02975j, 1.6829+0.0337j, 1.3705+0.9393j, 3.3329+0.502j, 3.406+0.05573j])
+    makeopac=np.array([[[2.21746e+03, 4.14092e+03, 8.53946e-01], [1.44035e+03, 9.49034e+03, 6.89220e-01], [3.28104e+03, 3.90314e+02, 6.39116e-02],
+                        [3.61779e+01, 6.40004e-02, 1.89837e-03], [3.86766e-01, 6.31472e-06, 1.99434e-05]],
+                       [[7.46858e+01, 9.51360e+01, 9.29698e-01], [7.78810e+01, 9.66569e+01, 9.30491e-01], [7.98774e+01, 1.09875e+02, 8.54760e-01],
+                        [1.20131e+02, 1.13130e+02, 5.34097e-01], [4.32883e-01, 1.75743e-01, 1.81909e-02]],
+                       [[2.20278e+00, 2.80641e+00, 9.28933e-01], [2.21039e+00, 2.81278e+00, 9.30331e-01], [1.96306e+00, 3.10646e+00, 8.57605e-01],
+                        [1.87642e+00, 3.42531e+00, 7.75878e-01], [2.17082e+00, 4.42415e+00, 7.18017e-01]]])
+    kabs, ksca, g = mie_opacities([1., 30., 1000.], lams, refrel, 3.)
+    assert np.allclose(np.stack((kabs, ksca), axis=-1), makeopac[:,:,:2], rtol=2.0e-3, atol=0.)
+    assert np.allclose(g, makeopac[:,:,2], rtol=2.0e-3, atol=1.0e-6)
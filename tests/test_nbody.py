@@ -0,0 +1,102 @@
+import os
+import numpy as np
+import pytest
+from scipy.spatial import cKDTree
+from disc2radmc.constants import au, M_earth
+from disc2radmc.functions_misc import kernel_deposit
+from disc2radmc.model import workspace, wavelength_grid, physical_grid, dust
+
+lnk_file=os.path.join(os.path.dirname(__file__), '..', 'opacities', 'dust_optical_constants', 'Sil_0.1_10000.lnk')
+
+
+def make_dust(tmp_path, **kwargs):
+    model=workspace(str(tmp_path/'model'))
+    lam_grid=wavelength_grid(lammin=1., lammax=1000., Nlam=3, workspace=model)
+    grid=physical_grid(Nr=10, Nphi=8, Nth=6, rmin=10., rmax=100., thmax=0.5, workspace=model, **kwargs)
+    return dust(lam_grid, amin=1., amax=1000., N_species=2, lnk_file=lnk_file, tag='sil', workspace=model), grid
+
+
+def particles(N, rmin, rmax, seed=0):
+    # x, y, z (au) of particles in a thick ring
+    rng=np.random.default_rng(seed)
+    r=rng.uniform(rmin, rmax, N)
+    phi=rng.uniform(0., 2.*np.pi, N)
+    z=rng.normal(0., 0.1*r)
+    return np.column_stack((r*np.cos(phi), r*np.sin(phi), z))
+
+
+def test_kernel_deposit_mass(tmp_path):
+    dust_i, grid = make_dust(tmp_path)
+    xyz_cells=np.column_stack([(grid.rhom*np.cos(grid.phim)).ravel(), (grid.rhom*np.sin(grid.phim)).ravel(), grid.zm.ravel()])
+    tree=cKDTree(np.concatenate((xyz_cells, xyz_cells*[1., 1., -1.]))) # mirrored as in dust_densities_Nbody
+    dV=grid.dV.ravel()
+    xyz=particles(2000, 5., 110.)
+    xyz[:,2]=np.abs(xyz[:,2])
+    rng=np.random.default_rng(1)
+    h=10.**rng.uniform(-2., 1.5, len(xyz)) # from far below to far above the cell size
+    h[:10]=0.
+    weights=rng.uniform(0.5, 1.5, len(xyz))
+    species=rng.integers(-1, 2, len(xyz))
+    r=np.sqrt(np.sum(xyz**2, axis=1))
+    cell=grid.cell_indices(np.arcsin(xyz[:,2]/r), np.arctan2(xyz[:,1], xyz[:,0])%(2.*np.pi), r)
+    assert np.any(cell<0) and np.any(cell>=0)
+
+    mass=kernel_deposit(xyz, h, weights, species, cell, tree, dV, 2*grid.Ncells)
+    # the mass of each species is conserved for particles inside the grid, and particles outside add at most their mass
+    for ia in range(2):
+        inside=(species==ia) & (cell>=0)
+        outside=(species==ia) & (cell<0)
+        deposited=np.sum(mass[ia*grid.Ncells:(ia+1)*grid.Ncells])
+        assert deposited>np.sum(weights[inside])*(1.+1.0e-6)
+        assert deposited<=(np.sum(weights[inside])+np.sum(weights[outside]))*(1.+1.0e-12)
+
+    # only particles inside the grid
+    mass_inside=kernel_deposit(xyz, h, weights, np.where(cell>=0, species, -1), cell, tree, dV, 2*grid.Ncells)
+    for ia in range(2):
+        assert np.isclose(np.sum(mass_inside[ia*grid.Ncells:(ia+1)*grid.Ncells]), np.sum(weights[(species==ia) & (cell>=0)]), rtol=1.0e-12)
+
+    # a particle in the midplane just beyond rmax deposits about half its mass in the outer cells (a fine grid samples its kernel
+    # well), and one far away nothing
+    grid_fine=physical_grid(Nr=40, Nphi=64, Nth=10, rmin=10., rmax=100., thmax=0.5, workspace=dust_i.workspace)
+    xyz_cells=np.column_stack([(grid_fine.rhom*np.cos(grid_fine.phim)).ravel(), (grid_fine.rhom*np.sin(grid_fine.phim)).ravel(), grid_fine.zm.ravel()])
+    tree_fine=cKDTree(np.concatenate((xyz_cells, xyz_cells*[1., 1., -1.])))
+    xyz_edge=np.array([[grid_fine.redge[-1]+0.01, 0., 0.], [1000., 0., 0.]])
+    mass_edge=kernel_deposit(xyz_edge, np.array([10., 10.]), np.ones(2), np.zeros(2, dtype=int), np.array([-1, -1]), tree_fine, grid_fine.dV.ravel(), grid_fine.Ncells)
+    assert 0.4<np.sum(mass_edge)<0.6
+    assert np.all(mass_edge.reshape(grid_fine.shape)[:,:,:-10]==0.)
+
+    # batches of particle-cell pairs give the same result
+    assert np.allclose(kernel_deposit(xyz, h, weights, species, cell, tree, dV, 2*grid.Ncells, max_pairs=1000), mass, rtol=1.0e-12, atol=0.)
+
+
+def test_kernel_pooled(tmp_path):
+    # the deposition distributed over a pool of processes agrees with the serial one
+    dust_i, grid = make_dust(tmp_path)
+    xyz=particles(3000, 8., 105.)
+    sizes=np.random.default_rng(2).uniform(1., 1000., len(xyz))
+    densities=[]
+    for workers in [1, 2]:
+        dust_i.dust_densities_Nbody(grid=grid, positions=xyz, sizes=sizes, kernel='cubic_spline', chunk_size=700, workers=workers)
+        densities.append(dust_i.dens_d)
+    assert np.all(densities[0]>=0.) and np.count_nonzero(densities[0])>0.5*densities[0].size
+    assert np.allclose(densities[1], densities[0], rtol=1.0e-12, atol=0.)
+
+
+@pytest.mark.parametrize('options', [dict(), dict(logtheta=True, logr=True, thmin=0.01)])
+def test_histogram(tmp_path, options):
+    # without a kernel, the density is the histogram of the particles (weighted by their masses and split by size) over the
+    # cells of linear or logarithmic grids, normalized to the mass of each species
+    dust_i, grid = make_dust(tmp_path, **options)
+    xyz=particles(20000, 5., 110.)
+    rng=np.random.default_rng(3)
+    masses=rng.uniform(0.5, 1.5, len(xyz))
+    sizes=10.**rng.uniform(-0.5, 3.5, len(xyz))
+    dust_i.dust_densities_Nbody(grid=grid, positions=np.column_stack((xyz, masses)), masses=3, sizes=sizes, chunk_size=3000)
+
+    r=np.sqrt(np.sum(xyz**2, axis=1))
+    coordinates=np.column_stack((sizes, np.abs(np.arcsin(xyz[:,2]/r)), np.arctan2(xyz[:,1], xyz[:,0])%(2.*np.pi), r))
+    counts=np.histogramdd(coordinates, bins=(dust_i.Agrid_edges, grid.thedge, grid.phiedge, grid.redge), weights=masses)[0]
+    density=counts/grid.dV
+    density*=(dust_i.Mgrid*M_earth/(2.*np.einsum('sijk,ijk->s', density, grid.dV)*au**3))[:,None,None,None]
+    assert np.count_nonzero(counts)>0.5*counts.size
+    assert np.allclose(dust_i.dens_d, density, rtol=1.0e-10, atol=0.)
@@ -0,0 +1,90 @@
+import fcntl
+import os
+import threading
+from disc2radmc.model import workspace, wavelength_grid, dust, opacity_cache
+
+lnk_file=os.path.join(os.path.dirname(__file__), '..', 'opacities', 'dust_optical_constants', 'Sil_0.1_10000.lnk')
+
+
+def compute(tmp_path, cache, name, lnk_file=lnk_file, amax=100., scattering_matrix=False, **kwargs):
+    # computes the opacities in a new model directory and returns the files written and whether they were computed
+    model=workspace(str(tmp_path/name))
+    lam_grid=wavelength_grid(lammin=0.5, lammax=1000., Nlam=5, workspace=model)
+    dust_i=dust(lam_grid, amin=1., amax=amax, N_species=2, N_per_bin=4, lnk_file=lnk_file, tag='sil', scattering_matrix=scattering_matrix, opacity_cache=cache, workspace=model)
+    calls=[]
+    size_averaged_opacities=dust_i.size_averaged_opacities
+
+    def counted(**kwargs):
+        calls.append(kwargs)
+        return size_averaged_opacities(**kwargs)
+    dust_i.size_averaged_opacities=counted
+    dust_i.compute_opacities(mie_code='python', **kwargs)
+    contents=[]
+    for j in range(2):
+        with open(model.path(('dustkapscatmat_sil_%i.inp' if scattering_matrix else 'dustkappa_sil_%i.inp')%(j+1)), 'r') as file_opacity:
+            contents.append(file_opacity.read())
+    return contents, len(calls)>0
+
+
+def test_hit_and_miss(tmp_path):
+    cache=opacity_cache(str(tmp_path/'cache'))
+    contents, computed = compute(tmp_path, cache, 'model1')
+    assert computed
+    assert compute(tmp_path, cache, 'model2')==(contents, False)
+
+    # any change of the inputs is a miss: optical constants (same file name, different bytes), size bins and xmax
+    lnk_modified=str(tmp_path/'Sil_0.1_10000.lnk')
+    with open(lnk_file, 'r') as file_lnk:
+        lines=file_lnk.readlines()
+    lines[-1]=lines[-1].replace('.', '.1', 1)
+    with open(lnk_modified, 'w') as file_lnk:
+        file_lnk.writelines(lines)
+    assert compute(tmp_path, cache, 'model3', lnk_file=lnk_modified)[1]
+    assert compute(tmp_path, cache, 'model4', amax=200.)[1]
+    assert compute(tmp_path, cache, 'model5', xmax=100.)[1]
+    # and now they are hits
+    assert compute(tmp_path, cache, 'model6', lnk_file=lnk_modified)[1]==False
+    assert compute(tmp_path, cache, 'model7', xmax=100.)[1]==False
+
+    # scattering matrices depend on chop_forward
+    contents, computed = compute(tmp_path, cache, 'model8', scattering_matrix=True)
+    assert computed
+    assert compute(tmp_path, cache, 'model9', scattering_matrix=True)==(contents, False)
+    assert compute(tmp_path, cache, 'model10', scattering_matrix=True, chop_forward=10.)[1]
+
+
+def test_eviction(tmp_path):
+    # the least recently used entries are removed once the cache is larger than max_size
+    cache=opacity_cache(str(tmp_path/'cache'), max_size=2500)
+    path=str(tmp_path/'opacity.inp')
+    for i, key in enumerate(['a', 'b', 'c']):
+        with open(path, 'w') as file_opacity:
+            file_opacity.write(key*1000)
+        cache.put(key, [path])
+        os.utime(os.path.join(cache.directory, key), (i, i))
+    assert sorted(os.listdir(cache.directory))==['.lock', 'b', 'c'] and cache.size()[0]==2000
+
+    assert cache.get('b', [path]) # b is now the most recently used
+    with open(path, 'r') as file_opacity:
+        assert file_opacity.read()=='b'*1000
+    with open(path, 'w') as file_opacity:
+        file_opacity.write('d'*1000)
+    cache.put('d', [path])
+    assert sorted(os.listdir(cache.directory))==['.lock', 'b', 'd']
+    assert not cache.get('c', [path])
+
+
+def test_eviction_lock(tmp_path):
+    # only one process evicts at a time
+    cache=opacity_cache(str(tmp_path/'cache'), max_size=0)
+    path=str(tmp_path/'opacity.inp')
+    with open(path, 'w') as file_opacity:
+        file_opacity.write('a')
+    with open(os.path.join(cache.directory, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        thread=threading.Thread(target=cache.put, args=('a', [path]))
+        thread.start()
+        thread.join(0.5)
+        assert thread.is_alive() and os.path.isdir(os.path.join(cache.directory, 'a'))
+    thread.join()
+    assert not os.path.exists(os.path.join(cache.directory, 'a'))
@@ -0,0 +1,43 @@
+import os
+import numpy as np
+from disc2radmc.model import workspace, wavelength_grid, opacity_table
+
+lnk_file=os.path.join(os.path.dirname(__file__), '..', 'opacities', 'dust_optical_constants', 'Sil_0.1_10000.lnk')
+
+
+def make_table(tmp_path, **kwargs):
+    model=workspace(str(tmp_path/'model'))
+    lam_grid=wavelength_grid(lammin=0.5, lammax=1000., Nlam=5, workspace=model)
+    return opacity_table(lam_grid, [lnk_file, lnk_file], [3., 3.], mass_fractions=[[0., 0.5, 1.]], porosities=[0., 0.3], amin=1., amax=100., Na=5, path=str(tmp_path/'table.npz'), **kwargs)
+
+
+def test_interpolate_nodes(tmp_path):
+    table=make_table(tmp_path, save=False)
+    for i, fraction in enumerate(table.mass_fractions[0]):
+        for j, porosity in enumerate(table.porosities):
+            kappa=table.interpolate([1.-fraction, fraction], porosity, table.a)
+            assert np.allclose(kappa, table.kappa[i,j], rtol=1.0e-6, atol=0.)
+
+    # kappa_sca is interpolated logarithmically, but linearly next to grid points where it is 0 (e.g. below the float32 range)
+    a=np.sqrt(table.a[1:]*table.a[:-1])
+    kappa=table.interpolate([1., 0.], 0., a)
+    assert np.allclose(kappa[...,1], np.sqrt(table.kappa[0,0,1:,:,1]*table.kappa[0,0,:-1,:,1]), rtol=1.0e-6)
+    table.kappa[0,0,2,:,1]=0.
+    del table.log_kappa
+    kappa=table.interpolate([1., 0.], 0., a)
+    assert np.all(np.isfinite(kappa))
+    assert np.allclose(kappa[1:3,:,1], 0.5*table.kappa[0,0,[1,3],:,1], rtol=1.0e-6)
+    assert np.allclose(kappa[[0,3],:,1], np.sqrt(table.kappa[0,0,[1,4],:,1]*table.kappa[0,0,[0,3],:,1]), rtol=1.0e-6)
+    assert np.array_equal(table.interpolate([1., 0.], 0., table.a[2])[0,:,1], np.zeros(table.lams.size))
+
+
+def test_save_load(tmp_path):
+    table=make_table(tmp_path)
+    loaded=opacity_table(path=str(tmp_path/'table.npz'), load=True)
+    assert np.array_equal(loaded.kappa, table.kappa) and loaded.kappa.dtype==table.kappa.dtype
+    for name in ['lams', 'densities', 'porosities', 'a']:
+        assert np.array_equal(getattr(loaded, name), getattr(table, name))
+    assert loaded.lnk_files==table.lnk_files and loaded.mixing_method==table.mixing_method
+    assert len(loaded.mass_fractions)==1 and np.array_equal(loaded.mass_fractions[0], table.mass_fractions[0])
+    a=np.logspace(0., 2., 13)
+    assert np.array_equal(loaded.interpolate([0.4, 0.6], 0.1, a), table.interpolate([0.4, 0.6], 0.1, a))
@@ -0,0 +1,33 @@
+import numpy as np
+from disc2radmc.constants import R_sun, au
+from disc2radmc.model import workspace, simulation, wavelength_grid, star, physical_grid
+
+
+def test_optically_thin_temperature(tmp_path):
+    # for an opacity kappa~nu**beta at all wavelengths and a blackbody star, the temperature of optically thin dust is
+    # T=Tstar*(Rstar/(2*r))**(2/(4+beta)), i.e. the blackbody temperature for grey dust (beta=0)
+    model=workspace(str(tmp_path/'model'))
+    sim=simulation(verbose=False, workspace=model)
+    lam_grid=wavelength_grid(lammin=0.01, lammax=1.0e5, Nlam=400, workspace=model)
+    star_bb=star(lam_grid, Tstar=-5000., Rstar=2., workspace=model)
+    grid=physical_grid(Nr=10, Nphi=1, Nth=3, rmin=1., rmax=200., logr=True, workspace=model)
+
+    betas=[0., 1., 2.]
+    with open(model.path('dustopac.inp'), 'w') as file_dustopac:
+        file_dustopac.write('2\n%d\n============================================================================\n'%len(betas))
+        for i, beta in enumerate(betas):
+            file_dustopac.write('1\n0\nbeta%d\n----------------------------------------------------------------------------\n'%i)
+            with open(model.path('dustkappa_beta%d.inp'%i), 'w') as file_opacity:
+                file_opacity.write('1\n%d\n'%lam_grid.Nlam+''.join('%.10e %.10e\n'%(lam, 10.*(lam/100.)**(-beta)) for lam in lam_grid.lams))
+
+    T=sim.optically_thin_temperature(star_bb, grid)
+
+    Rstar_au=star_bb.Rstar*R_sun/au
+    T_analytic=np.array([5000.*(Rstar_au/(2.*grid.r))**(2./(4.+beta)) for beta in betas])
+    assert T.shape==(3, 10)
+    assert np.allclose(T, T_analytic, rtol=1.0e-3)
+
+    # saved as dust_temperature.dat for the whole grid, as mctherm would
+    Ts=model.temperature(grid)
+    assert Ts.shape==(3, 3, 1, 10)
+    assert np.allclose(Ts, T[:,None,None,:])
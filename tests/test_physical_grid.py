@@ -0,0 +1,23 @@
+import os
+import numpy as np
+import pytest
+from disc2radmc.model import workspace, physical_grid
+
+
+@pytest.mark.parametrize('options', [dict(), dict(mirror=False), dict(logr=True, logtheta=True), dict(axisym=True, mirror=False), dict(Nth=1)])
+def test_save_load(tmp_path, options):
+    # a grid loaded from amr_grid.inp is the grid that was saved
+    model=workspace(str(tmp_path/'model'))
+    arguments=dict(Nr=7, Nphi=5, Nth=4, rmin=2., rmax=150., thmin=0.01, thmax=0.4)
+    arguments.update(options)
+    grid=physical_grid(workspace=model, **arguments)
+    grid.save()
+    for i in range(2): # parsing the file, and then from its cache
+        loaded=physical_grid(load=True, workspace=model)
+        for name in ['redge', 'thedge', 'phiedge', 'r', 'th', 'th_full', 'thedge_full', 'dth_full']:
+            assert np.allclose(getattr(loaded, name), getattr(grid, name), rtol=1.0e-12, atol=1.0e-15), name
+        for name in ['Nr', 'Nth', 'Nphi', 'Ncells', 'mirror', 'axisym', 'logr']:
+            assert getattr(loaded, name)==getattr(grid, name), name
+        assert loaded.logtheta==(grid.logtheta and grid.Nth>2)
+        assert np.allclose(loaded.dV, grid.dV, rtol=1.0e-12)
+    assert os.path.exists(model.path('amr_grid_cache.npz'))
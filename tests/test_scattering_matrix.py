@@ -0,0 +1,43 @@
+import os
+import numpy as np
+import pytest
+from disc2radmc.mie import integrate_scattering_matrix
+from disc2radmc.model import workspace, wavelength_grid, dust
+
+lnk_file=os.path.join(os.path.dirname(__file__), '..', 'opacities', 'dust_optical_constants', 'Sil_0.1_10000.lnk')
+
+
+def test_dustkapscatmat(tmp_path):
+    model=workspace(str(tmp_path/'model'))
+    lam_grid=wavelength_grid(lammin=0.5, lammax=1000., Nlam=6, workspace=model)
+    dust_sm=dust(lam_grid, amin=1., amax=100., N_species=1, N_per_bin=10, lnk_file=lnk_file, tag='sil', scattering_matrix=True, workspace=model)
+    dust_sm.compute_opacities()
+
+    # iformat, Nlam, Nang, (lam, kappa_abs, kappa_sca, g) at each wavelength, angles, and Z11, Z12, Z22, Z33, Z34, Z44 at each angle
+    # of each wavelength
+    with open(model.path('dustkapscatmat_sil_1.inp'), 'r') as file_opacity:
+        values=np.array(file_opacity.read().split(), dtype=float)
+    iformat, Nlam, Nang = values[:3].astype(int)
+    assert iformat==1 and Nlam==6
+    opct=values[3:3+4*Nlam].reshape(Nlam, 4)
+    theta=values[3+4*Nlam:3+4*Nlam+Nang]
+    Z=values[3+4*Nlam+Nang:].reshape(Nlam, Nang, 6)
+    assert np.allclose(opct[:,0], lam_grid.lams, rtol=1.0e-5)
+    assert theta[0]==0. and theta[-1]==180. and np.all(np.diff(theta)>0.)
+    assert np.all(opct[:,1:3]>0.) and np.all(Z[:,:,0]>0.)
+    assert np.array_equal(Z[:,:,0], Z[:,:,2]) and np.array_equal(Z[:,:,3], Z[:,:,5])
+
+    # radmc3d requires Z11 to integrate to kappa_sca within 1%, and the asymmetry parameter is consistent with Z11
+    ksca, g = integrate_scattering_matrix(theta, Z)
+    assert np.allclose(ksca, opct[:,2], rtol=1.0e-3)
+    assert np.allclose(g, opct[:,3], atol=1.0e-3)
+
+
+def test_dustkapscatmat_unresolved_peak(tmp_path):
+    # without chopping the forward peak, the coarse grid misses most of the light scattered by large grains
+    model=workspace(str(tmp_path/'model'))
+    lam_grid=wavelength_grid(lammin=0.5, lammax=1000., Nlam=6, workspace=model)
+    dust_sm=dust(lam_grid, amin=1., amax=100., N_species=1, N_per_bin=10, lnk_file=lnk_file, tag='sil', scattering_matrix=True, workspace=model)
+    with pytest.raises(ValueError, match='tolerance of radmc3d'):
+        dust_sm.compute_opacities(scattering_angles=np.linspace(0., 180., 181), chop_forward=0.)
+    assert not os.path.exists(model.path('dustkapscatmat_sil_1.inp'))
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+from disc2radmc.constants import au
+from disc2radmc.model import workspace, radmc3d_session
+
+
+def test_session(tmp_path, radmc3d):
+    model=workspace(str(tmp_path/'model'), radmc3d=radmc3d)
+    with radmc3d_session(model, threads=2) as session:
+        image, lam, sizepix_x, sizepix_y = session.image(wavelength=880., Npix=3, sizeau=30.)
+        assert image.shape==(1, 3, 3) and np.all(image==880.)
+        assert np.array_equal(lam, [880.])
+        assert np.isclose(sizepix_x, 10.*au) and np.isclose(sizepix_y, 10.*au)
+
+        image, lam, sizepix_x, sizepix_y = session.image(wavelength=[100., 1000.], Npix=2)
+        assert image.shape==(2, 2, 2) and np.array_equal(image[:,0,0], [100., 1000.])
+
+        # the wavelengths are those of each call
+        for wavelengths in [np.array([1., 10., 100.]), np.array([0.5, 5.])]:
+            lam, flux = session.spectrum(wavelengths)
+            assert np.array_equal(lam, wavelengths) and np.array_equal(flux, wavelengths)
+        process=session.process
+    assert process.returncode==0 # quit when closed
+
+
+def test_session_child_dies(tmp_path, radmc3d):
+    model=workspace(str(tmp_path/'model'), radmc3d=radmc3d)
+    session=radmc3d_session(model)
+    session.send('crash')
+    with pytest.raises(ChildProcessError, match='exit code 3'):
+        session.read_image()
+    session.close()
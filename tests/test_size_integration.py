@@ -0,0 +1,35 @@
+import numpy as np
+from disc2radmc.functions_misc import integrate_size_distribution
+
+
+def test_integrate_size_distribution():
+    # mass-weighted averages of a^q, which are (int a^(slope+4+q) dlog(a))/(int a^(slope+4) dlog(a)), and of a function with
+    # a sharp feature that needs refinement
+    edges=np.array([1., 10., 100., 1000.])
+    slope=-3.5
+    sizes=[]
+
+    def function(a):
+        sizes.append(a)
+        return np.stack((a**-1., a**2., 1.+np.exp(-0.5*(np.log(a/30.)/0.05)**2)), axis=-1)
+
+    averages, errors, Nevaluations = integrate_size_distribution(function, edges, slope, rtol=1.0e-4)
+
+    def power_average(q):
+        p=slope+4.
+        return (edges[1:]**(p+q)-edges[:-1]**(p+q))/(p+q)/((edges[1:]**p-edges[:-1]**p)/p)
+    u=np.log(edges[1])+(np.arange(200000)+0.5)*np.log(edges[2]/edges[1])/200000 # midpoint rule
+    weights=np.exp((slope+4.)*u)
+    feature=np.sum(weights*(1.+np.exp(-0.5*((u-np.log(30.))/0.05)**2)))/np.sum(weights)
+    exact=np.column_stack((power_average(-1.), power_average(2.), [1., feature, 1.]))
+
+    error=np.max(np.abs(averages/exact-1.), axis=1)
+    assert np.all(error<1.0e-4)
+    assert np.all(errors<1.0e-4) and np.all(errors>=error) # the estimated errors are not smaller than the true errors
+
+    # every size is evaluated once (nodes are reused when intervals are split and bin edges are shared), and only the bin
+    # with the feature is refined much
+    sizes=np.concatenate(sizes)
+    assert sizes.size==Nevaluations and np.unique(sizes).size==Nevaluations
+    counts=np.histogram(sizes, edges)[0]
+    assert counts[1]>2*max(counts[0], counts[2])
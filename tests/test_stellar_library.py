@@ -0,0 +1,35 @@
+import numpy as np
+from disc2radmc.model import stellar_library
+
+
+def write_template(directory, name, flux):
+    np.savetxt(str(directory/name), np.column_stack((np.array([3000., 1000., 2000.]), np.full(3, flux))))
+
+
+def test_only_solar_templates(tmp_path):
+    templates=tmp_path/'templates'
+    templates.mkdir()
+    write_template(templates, 'lte100-4.0-0.0a+0.0.BT-NextGen.7.dat.txt', 1.)
+    write_template(templates, 'lte100-4.0-0.5a+0.2.BT-NextGen.7.dat.txt', 2.) # sorted after the solar template
+    write_template(templates, 'lte100-4.0+0.3a+0.0.BT-NextGen.7.dat.txt', 3.)
+    write_template(templates, 'lte100-4.0-0.0.BT-Settl.7.dat.txt', 4.)
+    write_template(templates, 'lte020-4.5-0.0.BT-Settl.7.dat.txt', 5.)
+    write_template(templates, 'lte020-4.5-0.5.BT-Settl.7.dat.txt', 6.)
+    library=stellar_library(str(tmp_path/'library'), dir_stellar_templates=str(templates))
+
+    assert len(library.Teff)==2
+    wavelengths, flux = library.spectrum(10000., 4.)
+    assert np.array_equal(wavelengths, [1000., 2000., 3000.])
+    assert np.all(flux==1.)
+    wavelengths, flux = library.spectrum(2000., 4.5)
+    assert np.all(flux==5.)
+
+
+def test_flux_precision(tmp_path):
+    # fluxes are stored without rounding, including the tiny fluxes of cool stars at short wavelengths
+    templates=tmp_path/'templates'
+    templates.mkdir()
+    flux=np.array([1.2345678901234567e-60, 3.141592653589793e-5, 2.718281828459045e7])
+    np.savetxt(str(templates/'lte030-4.0-0.0.BT-Settl.7.dat.txt'), np.column_stack(([1000., 2000., 3000.], flux)), fmt='%.17e')
+    library=stellar_library(str(tmp_path/'library'), dir_stellar_templates=str(templates))
+    assert np.array_equal(library.spectrum(3000., 4.)[1], flux)
@@ -0,0 +1,149 @@
+import os
+import re
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pytest
+from disc2radmc.functions_misc import load_image
+from disc2radmc.model import workspace, radmc3d_job, simulation, wavelength_grid, dust
+
+
+def make_workspace(tmp_path, radmc3d):
+    model=workspace(str(tmp_path/'model'), radmc3d=radmc3d)
+    with open(model.path('radmc3d.inp'), 'w') as file_radmc3d:
+        file_radmc3d.write('nphot = 1000 \n')
+    return model
+
+
+def scratch_directories(model):
+    return [name for name in os.listdir(model.directory) if name.startswith('.job_')]
+
+
+def test_run_job(tmp_path, radmc3d):
+    model=make_workspace(tmp_path, radmc3d)
+    with open(model.path('dust_temperature.dat'), 'w') as file_temperature:
+        file_temperature.write('old')
+    calls=[]
+
+    def callback(directory):
+        # the image is already at its destination and the job runs in its own directory
+        calls.append(directory)
+        assert os.path.exists(model.path('image_880.out'))
+        assert not os.path.exists(os.path.join(directory, 'image.out'))
+        assert os.path.exists(os.path.join(directory, 'camera_wavelength_micron.inp'))
+        return 'converted'
+
+    job=radmc3d_job('radmc3d image npix 4 loadlambda sizeau 100', files={'camera_wavelength_micron.inp': '1\n880.\n'}, radmc3d_lines=['camera_tracemode = -2'],
+                    outputs={'image.out': model.path('image_880.out')}, callback=callback, log='image_880.log')
+    assert model.run_job(job)=='converted'
+
+    directory=calls[0]
+    assert os.path.dirname(directory)==model.directory
+    with open(model.path('cwd.txt'), 'r') as file_cwd: # new files are moved to the model directory
+        assert os.path.realpath(file_cwd.read())==os.path.realpath(directory)
+    image, nx, ny, nf, lam, pixdeg_x, pixdeg_y = load_image(model.path('image_880.out'), 100., taumap=True)
+    assert (nx, ny, nf)==(4, 4, 1) and np.all(image==880.)
+
+    # the extra input files and radmc3d.inp lines only exist in the job directory, which is removed
+    with open(model.path('image_880.log'), 'r') as file_log:
+        assert 'camera_tracemode = -2' in file_log.read()
+    with open(model.path('radmc3d.inp'), 'r') as file_radmc3d:
+        assert 'camera_tracemode' not in file_radmc3d.read()
+    assert not os.path.exists(model.path('camera_wavelength_micron.inp'))
+    assert not os.path.exists(directory)
+    assert scratch_directories(model)==[]
+    with open(model.path('dust_temperature.dat'), 'r') as file_temperature:
+        assert file_temperature.read()=='old'
+
+
+def test_writes(tmp_path, radmc3d):
+    # files in writes are not linked, so the previous file is replaced instead of being written through the link
+    model=make_workspace(tmp_path, radmc3d)
+    with open(model.path('dust_temperature.dat'), 'w') as file_temperature:
+        file_temperature.write('old')
+    model.run_job(radmc3d_job('radmc3d mctherm', writes=['dust_temperature.dat']))
+    with open(model.path('dust_temperature.dat'), 'r') as file_temperature:
+        assert file_temperature.read().split()[-1]=='10.0'
+    assert not os.path.islink(model.path('dust_temperature.dat'))
+
+
+def test_run_job_failure(tmp_path, radmc3d):
+    model=make_workspace(tmp_path, radmc3d)
+    calls=[]
+    job=radmc3d_job('radmc3d fail', outputs={'image.out': model.path('image.out')}, callback=calls.append, log='fail.log')
+    with pytest.raises(subprocess.CalledProcessError):
+        model.run_job(job)
+    assert calls==[]
+    with open(model.path('fail.log'), 'r') as file_log:
+        assert 'ERROR: stand-in failure' in file_log.read()
+    assert scratch_directories(model)==[]
+
+
+def test_run_jobs_parallel(tmp_path, radmc3d, monkeypatch):
+    monkeypatch.setenv('RADMC3D_STANDIN_SLEEP', '1')
+    model=make_workspace(tmp_path, radmc3d)
+    wavelengths=[100., 200., 300., 400.]
+    jobs=[radmc3d_job('radmc3d image npix 2 lambda %g sizeau 100 imageunform'%wavelength, outputs={'image.bout': model.path('image_%g.bout'%wavelength)},
+                      callback=lambda directory, wavelength=wavelength: load_image(model.path('image_%g.bout'%wavelength), 100., taumap=True)[0], log='image_%g.log'%wavelength)
+          for wavelength in wavelengths]
+    images=model.run_jobs(jobs, workers=4, threads=2)
+
+    for wavelength, image in zip(wavelengths, images):
+        assert image.shape==(1, 1, 2, 2) and np.all(image==wavelength)
+    intervals=[]
+    for wavelength in wavelengths:
+        with open(model.path('image_%g.log'%wavelength), 'r') as file_log:
+            log=file_log.read()
+        assert 'setthreads 2' in log
+        intervals.append([float(x) for x in re.search(r'running from (\S+) to (\S+)', log).groups()])
+    intervals=np.array(intervals)
+    assert np.max(intervals[:,0])<np.min(intervals[:,1]) # all jobs were running at the same time
+    assert scratch_directories(model)==[]
+
+
+def test_run_jobs_same_log(tmp_path, radmc3d):
+    model=make_workspace(tmp_path, radmc3d)
+    jobs=[radmc3d_job('radmc3d mctherm', log='same.log') for i in range(2)]
+    with pytest.raises(AssertionError):
+        model.run_jobs(jobs, workers=2)
+
+
+def test_image_job_logs(tmp_path, radmc3d):
+    model=workspace(str(tmp_path/'model'), radmc3d=radmc3d)
+    sim=simulation(verbose=False, workspace=model)
+    logs=[sim.image_job(imagename='disc', wavelength=wavelength, tag=str(wavelength)).log for wavelength in [880., 1300.]]
+    logs+=[sim.image_job(imagename='disc', tag='880.0', taumap=True).log, sim.cube_job(imagename='co', tag='880.0').log]
+    assert len(set(logs))==len(logs)
+
+
+def write_files(directory, names):
+    model=workspace(directory)
+    for name in names:
+        with open(model.path(name), 'w') as file_output:
+            file_output.write(name)
+        model.record(name, name)
+
+
+def test_record_parallel(tmp_path):
+    # processes recording files in the same workspace at the same time do not drop each other's entries
+    model=workspace(str(tmp_path/'model'))
+    names=[['file_%i_%i'%(i, j) for j in range(50)] for i in range(4)]
+    with ProcessPoolExecutor(4) as executor:
+        list(executor.map(write_files, [model.directory]*4, names))
+    assert sorted(model.load_manifest())==sorted(sum(names, []))
+    assert all(model.unchanged(name, name) for name in sum(names, []))
+    assert [name for name in os.listdir(model.directory) if 'tmp' in name]==[]
+
+
+def test_write_dustopac(tmp_path):
+    # dustopac.inp is only rewritten when the species change
+    model=workspace(str(tmp_path/'model'))
+    lam_grid=wavelength_grid(lammin=0.5, lammax=1000., Nlam=5, workspace=model)
+    lnk_file=os.path.join(os.path.dirname(__file__), '..', 'opacities', 'dust_optical_constants', 'Sil_0.1_10000.lnk')
+    dust(lam_grid, N_species=2, lnk_file=lnk_file, tag='sil', workspace=model)
+    mtime=os.stat(model.path('dustopac.inp')).st_mtime_ns
+    dust(lam_grid, N_species=2, lnk_file=lnk_file, tag='sil', workspace=model)
+    assert os.stat(model.path('dustopac.inp')).st_mtime_ns==mtime
+    dust(lam_grid, N_species=2, lnk_file=lnk_file, tag='sil', scattering_matrix=True, workspace=model)
+    with open(model.path('dustopac.inp'), 'r') as file_dustopac:
+        assert file_dustopac.read().count('dustkapscatmat')==2